@@ -1,12 +1,23 @@
 import asyncio
 
 from logs_setup import logger, new_session_log
+from metrics import api_metrics, run_metrics_server
+from ratelimit import outbound_limiter
+from scheduler import update_scheduler
+from storage import create_storage
 
-from config import TOKEN, MessageTexts, QuestionsData
+from config import (
+    TOKEN,
+    BOT_MODE,
+    BOT_MODES,
+    DATA_WATCH,
+    METRICS_PORT,
+    QuestionsData,
+    RenderCache,
+)
 
 from aiogram.enums import ParseMode
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import BotCommand, BotCommandScopeAllPrivateChats
 
@@ -14,11 +25,22 @@ _bot_settings = {"parse_mode": ParseMode.HTML}
 BOT_PROPERTIES = DefaultBotProperties(**_bot_settings)
 
 bot = Bot(TOKEN, default=BOT_PROPERTIES)
-storage = MemoryStorage()
+bot.session.middleware(outbound_limiter)
+# registered after the limiter, so its waits are not counted as api latency
+bot.session.middleware(api_metrics)
+storage = create_storage()
 dp = Dispatcher(storage=storage)
+# the scheduler goes between aiogram's user context and FSM middlewares, so
+# FSM state is read by the worker when the update runs, not when it is queued
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(update_scheduler)
+dp.update.outer_middleware(dp.fsm)
+dp.shutdown.register(update_scheduler.close)
+# workers must be stopped before the FSM storage that aiogram closes first
+dp.shutdown.handlers.insert(0, dp.shutdown.handlers.pop())
 
-msg_texts = MessageTexts()
 questions_data = QuestionsData()
+render_cache = RenderCache()
 
 
 async def on_startup():
@@ -30,19 +52,37 @@ async def on_startup():
         ],
         scope=BotCommandScopeAllPrivateChats(),
     )
-    from utils import startup_admins_notify, load_json_data
+    from utils import (
+        startup_admins_notify,
+        load_json_data,
+        watch_json_data,
+        start_background_task,
+    )
 
     await startup_admins_notify()
     await load_json_data()
-    await dp.start_polling(bot)
+    if DATA_WATCH:
+        start_background_task(watch_json_data(), name="data-watcher")
+    if METRICS_PORT:
+        start_background_task(run_metrics_server(), name="metrics-server")
+    if BOT_MODE == BOT_MODES.WEBHOOK.value:
+        from webhook import run_webhook
+
+        await run_webhook(dp, bot)
+    else:
+        await bot.delete_webhook()
+        # updates are handed to the scheduler one by one, so a full queue
+        # stops polling instead of piling up tasks
+        await dp.start_polling(bot, handle_as_tasks=False)
 
 
 if __name__ == "__main__":
     new_session_log()
 
-    from handlers import users_router, admins_router
+    from handlers import users_router, admins_router, inline_router
 
     dp.include_router(admins_router)
     dp.include_router(users_router)
+    dp.include_router(inline_router)
 
     asyncio.run(on_startup())
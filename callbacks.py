@@ -0,0 +1,43 @@
+from enum import Enum
+
+from aiogram.filters.callback_data import CallbackData
+
+
+class NAV_ACTIONS(str, Enum):
+    GO = "g"
+    BACK = "b"
+
+
+class NavCallback(CallbackData, prefix="n"):
+    """Menu navigation button: n:<action>:<node id>:<page>"""
+
+    action: NAV_ACTIONS
+    id: int
+    page: int = 0
+
+
+def go_data(node_id: int, page: int = 0) -> str:
+    return NavCallback(action=NAV_ACTIONS.GO, id=node_id, page=page).pack()
+
+
+def back_data(node_id: int) -> str:
+    return NavCallback(action=NAV_ACTIONS.BACK, id=node_id).pack()
+
+
+# callback data prefix -> decoder
+DECODERS = {
+    NavCallback.__prefix__: NavCallback.unpack,
+}
+
+
+def decode_callback(data: str | None) -> NavCallback | None:
+    """Returns None for unknown or malformed callback data"""
+    if not data:
+        return None
+    decoder = DECODERS.get(data.split(":", 1)[0])
+    if decoder is None:
+        return None
+    try:
+        return decoder(data)
+    except (TypeError, ValueError):
+        return None
@@ -1,15 +1,110 @@
+from array import array
+from dataclasses import dataclass, field, replace
 from enum import Enum
 
 from dotenv import load_dotenv
 import os
 
+from search import SearchIndex
 from singleton import singleton
 
 load_dotenv()
 TOKEN = os.getenv("TOKEN")
 ADMINS = [int(x) for x in os.getenv("ADMINS").split(",")]
+# сколько админов уведомляются параллельно
+ADMIN_NOTIFY_CONCURRENCY = 5
+# одинаковые ошибки за это время (сек) приходят админам одной сводкой
+ERROR_DIGEST_WINDOW = 60
+ERROR_DIGEST_MAX_USERS = 10000
+
+
+# Режим получения обновлений: polling или webhook
+class BOT_MODES(Enum):
+    POLLING = "polling"
+    WEBHOOK = "webhook"
+
+
+BOT_MODE = os.getenv("BOT_MODE", BOT_MODES.POLLING.value)
+# публичный адрес, который сообщается телеграму (пустой - webhook не ставится,
+# удобно для локальной проверки POST запросами)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
 
 JSON_DATA_PATH = "data.json"
+# Ограничения на загружаемый файл данных
+DATA_MAX_SIZE = int(os.getenv("DATA_MAX_SIZE", str(50 * 1024 * 1024)))  # байт
+DATA_MAX_DEPTH = int(os.getenv("DATA_MAX_DEPTH", "32"))  # вложенность категорий
+DATA_MAX_NODES = int(os.getenv("DATA_MAX_NODES", "500000"))  # категорий и вопросов
+
+# Обработка апдейтов: параллельно по чатам, по порядку внутри чата
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+# сколько апдейтов может ждать обработки, дальше polling притормаживается
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# сколько апдейтов одного чата может ждать в очереди, лишние отбрасываются
+UPDATE_CHAT_QUEUE_SIZE = int(os.getenv("UPDATE_CHAT_QUEUE_SIZE", "5"))
+# сколько секунд при остановке дожидаться обработки уже принятых апдейтов
+UPDATE_DRAIN_TIMEOUT = 10
+
+# Ограничение частоты запросов от одного пользователя (апдейтов в секунду)
+# не выше исходящего лимита на чат (RATE_LIMIT_PRIVATE_CHAT и
+# RATE_LIMIT_CHAT_BURST), иначе ответы одному пользователю копятся в очереди
+THROTTLE_RATE = 1
+THROTTLE_BURST = 3
+THROTTLE_MAX_USERS = 50000
+
+
+# Хранилище состояний FSM: memory, sqlite или redis
+class FSM_STORAGES(Enum):
+    MEMORY = "memory"
+    SQLITE = "sqlite"
+    REDIS = "redis"
+
+
+FSM_STORAGE = os.getenv("FSM_STORAGE", FSM_STORAGES.SQLITE.value)
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "fsm.sqlite3")
+FSM_FLUSH_INTERVAL = 1.0  # секунд между пакетными записями на диск
+FSM_CACHE_SIZE = 100000
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+
+# Навигация по меню: edit - меняется то же сообщение, send - новое сообщение
+class NAVIGATION_MODES(Enum):
+    EDIT = "edit"
+    SEND = "send"
+
+
+NAVIGATION_MODE = os.getenv("NAVIGATION_MODE", NAVIGATION_MODES.EDIT.value)
+# следить за изменениями файла данных на диске и подхватывать их без рестарта
+DATA_WATCH = os.getenv("DATA_WATCH", "1") == "1"
+DATA_WATCH_INTERVAL = 5  # секунд между проверками, если нет watchfiles
+# хранилище резервных копий файла данных (для /rollback)
+BACKUPS_DIR = "data_backups"
+BACKUPS_KEEP = 20
+# скомпилированный кэш данных для быстрого старта (пересобирается сам)
+COMPILED_DATA_PATH = JSON_DATA_PATH + ".cache"
+# полные дампы необработанных апдейтов в debug лог (в проде выключено)
+LOG_UPDATE_PAYLOADS = os.getenv("LOG_UPDATE_PAYLOADS", "0") == "1"
+
+# Prometheus метрики на локальном порту (0 - выключено), /stats работает всегда
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Лимиты исходящих сообщений телеграма (сообщений в секунду)
+RATE_LIMIT_GLOBAL = 30
+RATE_LIMIT_PRIVATE_CHAT = 1
+RATE_LIMIT_GROUP_CHAT = 20 / 60
+RATE_LIMIT_CHAT_BURST = 3
+RATE_LIMIT_MAX_RETRIES = 3
+SEARCH_RESULTS_LIMIT = 10
+# пунктов на одной странице меню (телеграм принимает до 100 кнопок и 4096 символов)
+MENU_PAGE_SIZE = int(os.getenv("MENU_PAGE_SIZE", "24"))
+MESSAGE_TEXT_LIMIT = 4096  # длина текста сообщения в телеграме (в utf-16)
+INLINE_RESULTS_LIMIT = 20
+INLINE_CACHE_TIME = 300  # секунд кэша результатов на стороне телеграма
+INLINE_LRU_SIZE = 1024
 
 
 # Данные снизу парятся из файла (внизу дефолтные значения)
@@ -19,79 +114,160 @@ class TEXTS_LABELS(Enum):
     UNKNOWN = "unknown"
 
 
-@singleton
-class MessageTexts:
-    def __init__(self):
-        self.TEXTS = {
+class CategoryNode:
+    __slots__ = ("name", "is_category")
+
+    def __init__(self, name: str, is_category: bool = True):
+        self.name = name
+        # False - обертка над вопросом верхнего уровня
+        self.is_category = is_category
+
+    def __eq__(self, other):
+        if not isinstance(other, CategoryNode):
+            return NotImplemented
+        return self.name == other.name and self.is_category == other.is_category
+
+    def __repr__(self):
+        return f"CategoryNode({self.name!r}, is_category={self.is_category})"
+
+
+class QuestionNode:
+    __slots__ = ("question", "answer", "category_id")
+
+    def __init__(self, question: str, answer: str, category_id: int):
+        self.question = question
+        self.answer = answer
+        self.category_id = category_id
+
+    def __eq__(self, other):
+        if not isinstance(other, QuestionNode):
+            return NotImplemented
+        return (
+            self.question == other.question
+            and self.answer == other.answer
+            and self.category_id == other.category_id
+        )
+
+    def __repr__(self):
+        return f"QuestionNode({self.question!r}, category_id={self.category_id})"
+
+
+@dataclass(frozen=True)
+class DataSnapshot:
+    """Consistent read-only view of all loaded data"""
+
+    generation: int = 0
+    texts: dict = field(
+        default_factory=lambda: {
             TEXTS_LABELS.START.value: "start text",
             TEXTS_LABELS.SELECT.value: "select text",
             TEXTS_LABELS.UNKNOWN.value: "unknown text",
         }
+    )
+    # id -> CategoryNode / QuestionNode
+    categories: dict = field(default_factory=dict)
+    questions: dict = field(default_factory=dict)
+    # плоские индексы дерева (строятся в parse_json): id -> id родителя,
+    # id категории -> array("q") id ее пунктов по порядку
+    parents: dict = field(default_factory=dict)
+    children: dict = field(default_factory=lambda: {0: array("q")})
+    search_index: SearchIndex = field(default_factory=SearchIndex)
+    # sha256 исходного файла, из которого собран снимок
+    source_hash: str = ""
 
-    def set_new_texts(self, new_texts: dict):
-        self.TEXTS = new_texts
+    def get_item_parent(self, item_id: int) -> int:
+        return self.parents.get(item_id, 0)
+
+    def get_category_items(self, cat_id: int):
+        return self.children.get(cat_id)
+
+    def get_item_path(self, item_id: int) -> tuple:
+        path = []
+        while item_id in self.parents:
+            path.append(item_id)
+            item_id = self.parents[item_id]
+        return tuple(reversed(path))
+
+    def get_item_depth(self, item_id: int) -> int:
+        return len(self.get_item_path(item_id))
 
 
 @singleton
 class QuestionsData:
     def __init__(self):
-        self.QUESTIONS_TREE = {}
-        self.CATEGORIES = {}
-        self.QUESTIONS = {}
+        self.SNAPSHOT = DataSnapshot()
 
-    def set_new_tree(self, new_tree: dict):
-        self.QUESTIONS_TREE = new_tree
+    @property
+    def GENERATION(self) -> int:
+        return self.SNAPSHOT.generation
 
-    def set_new_cats(self, new_cats: dict):
-        self.CATEGORIES = new_cats
+    def publish(self, snapshot: DataSnapshot) -> DataSnapshot:
+        # новые данные подменяются одним присваиванием ссылки
+        snapshot = replace(snapshot, generation=self.SNAPSHOT.generation + 1)
+        self.SNAPSHOT = snapshot
+        return snapshot
 
-    def set_new_questions(self, new_questions: dict):
-        self.QUESTIONS = new_questions
 
-    def get_item_parent(self, item_id: int) -> int:
-        def find_parent(tree, target_id):
-            if isinstance(tree, dict):
-                for cat_id, items in tree.items():
-                    for item in items:
-                        if item == target_id:
-                            return cat_id
-                        if isinstance(item, dict):
-                            if target_id in item:
-                                return cat_id
-                            for subcat_id, subitems in item.items():
-                                parent = find_parent({subcat_id: subitems}, target_id)
-                                if parent:
-                                    return parent
-            return 0
-
-        return find_parent(self.QUESTIONS_TREE, item_id)
+@singleton
+class RenderCache:
+    def __init__(self):
+        self.GENERATION = 0
+        self.MENUS = {}
+        # question id -> готовые kwargs сообщения с ответом и клавиатура
+        self.ANSWERS = {}
 
-    def get_category_items(self, cat_id: int):
-        def find_category_and_get_top_level_members(
-            tree, category_id, current_level=None
-        ):
-            if current_level is None:
-                current_level = tree
-            for key, value in current_level.items():
-                if key == category_id:
-                    return value
-                elif isinstance(value, list):
-                    for item in value:
-                        if isinstance(item, dict):
-                            result = find_category_and_get_top_level_members(
-                                tree, category_id, item
-                            )
-                            if result is not None:
-                                return result
-                elif isinstance(value, dict):
-                    result = find_category_and_get_top_level_members(
-                        tree, category_id, value
-                    )
-                    if result is not None:
-                        return result
+    def get_menu(self, generation: int, parent_id: int, page: int = 0):
+        if generation != self.GENERATION:
+            return None
+        return self.MENUS.get((parent_id, page))
+
+    def set_menu(self, generation: int, parent_id: int, page: int, menu: tuple):
+        if generation < self.GENERATION:
+            # рендер по устаревшему снимку не кэшируем
+            return
+        if generation > self.GENERATION:
+            self.drop(generation)
+        self.MENUS[(parent_id, page)] = menu
 
+    def get_answer(self, generation: int, q_id: int):
+        if generation != self.GENERATION:
             return None
+        return self.ANSWERS.get(q_id)
 
-        return find_category_and_get_top_level_members(
-            self.QUESTIONS_TREE, category_id=cat_id
-        )
+    def set_answer(self, generation: int, q_id: int, answer: tuple):
+        if generation < self.GENERATION:
+            return
+        if generation > self.GENERATION:
+            self.drop(generation)
+        self.ANSWERS[q_id] = answer
+
+    def warm(self, generation: int, menus: dict):
+        if generation < self.GENERATION:
+            return
+        if generation > self.GENERATION:
+            self.ANSWERS = {}
+        self.GENERATION = generation
+        self.MENUS = dict(menus)
+
+    def fill(self, generation: int, menus: dict):
+        # в отличие от warm не вытесняет уже отрисованные страницы
+        if generation != self.GENERATION:
+            return
+        self.MENUS.update(menus)
+
+    def advance(self, generation: int, stale_menus: set, stale_answers: set):
+        # меню и ответы, не затронутые обновлением, переходят в новое поколение
+        self.MENUS = {
+            key: menu for key, menu in self.MENUS.items() if key[0] not in stale_menus
+        }
+        self.ANSWERS = {
+            q_id: answer
+            for q_id, answer in self.ANSWERS.items()
+            if q_id not in stale_answers
+        }
+        self.GENERATION = generation
+
+    def drop(self, generation: int = 0):
+        self.GENERATION = generation
+        self.MENUS = {}
+        self.ANSWERS = {}
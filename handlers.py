@@ -1,166 +1,279 @@
-import json
 from json import JSONDecodeError
 
 from aiogram import Router
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.types import (
     Message,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
     FSInputFile,
+    InlineQuery,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
 )
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
-from aiogram.utils.formatting import Text, BlockQuote, Bold
+from aiogram.utils.formatting import Text, BlockQuote, Bold, Code, Pre
 
-from config import TEXTS_LABELS, JSON_DATA_PATH
+from callbacks import NAV_ACTIONS, NavCallback, decode_callback, go_data
+from config import (
+    TEXTS_LABELS,
+    JSON_DATA_PATH,
+    DATA_MAX_SIZE,
+    SEARCH_RESULTS_LIMIT,
+    INLINE_RESULTS_LIMIT,
+    INLINE_CACHE_TIME,
+    INLINE_LRU_SIZE,
+    MESSAGE_TEXT_LIMIT,
+    LOG_UPDATE_PAYLOADS,
+    NAVIGATION_MODE,
+    NAVIGATION_MODES,
+    DataSnapshot,
+)
 from filters import IsAdminFilter
 from logs_setup import logger
-from middlewares import ErrorMiddleware
+from metrics import InstrumentationMiddleware, metrics, stats_lines
+from middlewares import ErrorMiddleware, ThrottlingMiddleware
 
-from app import msg_texts, questions_data
+from app import questions_data, render_cache
 from utils import (
-    number_to_emojis,
-    parse_json,
+    render_items,
+    render_menu,
+    render_answer,
+    menu_pages,
+    item_page,
+    update_json_data,
+    run_in_data_thread,
+    backup_store,
     DataParseException,
     json_format_error_notify,
     json_updated_notify,
-    backup_file,
+    LRUCache,
+    shorten,
+    text_length,
 )
 
 # Routers
+throttling = ThrottlingMiddleware()
+metrics.add_source("throttling", throttling.stats)
+instrumentation = InstrumentationMiddleware()
+
 users_router = Router(name="users")
+users_router.message.middleware(throttling)
+users_router.callback_query.middleware(throttling)
 users_router.message.middleware(ErrorMiddleware())
 users_router.callback_query.middleware(ErrorMiddleware())
+users_router.message.middleware(instrumentation)
+users_router.callback_query.middleware(instrumentation)
+
+inline_router = Router(name="inline")
+inline_router.inline_query.middleware(ErrorMiddleware())
+inline_router.inline_query.middleware(instrumentation)
+inline_results_cache = LRUCache(maxsize=INLINE_LRU_SIZE)
 
 admins_router = Router(name="admins")
 admins_router.message.filter(IsAdminFilter(is_admin=True))
 admins_router.callback_query.filter(IsAdminFilter(is_admin=True))
+admins_router.message.middleware(throttling)
+admins_router.callback_query.middleware(throttling)
 admins_router.message.middleware(ErrorMiddleware())
 admins_router.callback_query.middleware(ErrorMiddleware())
+admins_router.message.middleware(instrumentation)
+admins_router.callback_query.middleware(instrumentation)
 
 
-def _generate_kb(parent_id: int = 0) -> (str, InlineKeyboardMarkup | None):
-    tree = questions_data.QUESTIONS_TREE
-    if parent_id != 0:
-        tree = questions_data.get_category_items(cat_id=parent_id)
-    kb = None
-    buttons = []
-    current_row = -1
-    counter = 0
-    text = ""
-    items = tree.keys() if isinstance(tree, dict) else tree
-    for k in items:
-        if isinstance(k, dict):
-            key = list(k.keys())[0]
-        else:
-            key = k
-        counter += 1
-        if key < 0:
-            name = questions_data.QUESTIONS[key]["question"]
-            text += f"{counter}. ❔ {name}\n\n"
-        else:
-            name = questions_data.CATEGORIES[key]["name"]
-            text += f"{counter}. 🏷 {name}\n\n"
-        current_row += 1
-        if current_row > 2:
-            current_row = 0
-        if current_row == 0:
-            buttons.append(
-                [
-                    InlineKeyboardButton(
-                        text=f"{number_to_emojis(counter)}",
-                        callback_data=f"go_by_id:{key}",
-                    )
-                ]
-            )
-        else:
-            buttons[-1].append(
-                InlineKeyboardButton(
-                    text=f"{number_to_emojis(counter)}", callback_data=f"go_by_id:{key}"
-                )
-            )
+def _generate_kb(
+    data: DataSnapshot, parent_id: int = 0, page: int = 0
+) -> (str, InlineKeyboardMarkup | None):
+    # buttons from older messages can point past the end of a shrunk category
+    page = min(max(page, 0), menu_pages(data, parent_id) - 1)
+    menu = render_cache.get_menu(data.generation, parent_id, page)
+    if menu is None:
+        menu = render_menu(data, parent_id, page)
+        render_cache.set_menu(data.generation, parent_id, page, menu)
+    return menu
 
-    if buttons:
-        if parent_id != 0:
-            buttons.append(
-                [
-                    InlineKeyboardButton(
-                        text="⬅️ Назад", callback_data=f"back_by_id:{parent_id}"
-                    ),
-                    InlineKeyboardButton(
-                        text="⏺️ Главная", callback_data=f"go_by_id:{0}"
-                    ),
-                ]
-            )
-        kb = InlineKeyboardMarkup(inline_keyboard=buttons)
 
-    return text, kb
+def _search_kb(data: DataSnapshot, query: str) -> (str, InlineKeyboardMarkup | None):
+    found = data.search_index.search(query, limit=SEARCH_RESULTS_LIMIT)
+    if not found:
+        return "", None
+    text, buttons = render_items(data, found)
+    buttons.append([InlineKeyboardButton(text="⏺️ Главная", callback_data=go_data(0))])
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def _get_back_kb(parent_id: int = 0) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="⬅️ Назад", callback_data=f"back_by_id:{parent_id}"
-                ),
-                InlineKeyboardButton(text="⏺️ Главная", callback_data=f"go_by_id:{0}"),
-            ]
-        ]
-    )
+def _get_answer(data: DataSnapshot, q_id: int) -> (dict, InlineKeyboardMarkup):
+    answer = render_cache.get_answer(data.generation, q_id)
+    if answer is None:
+        answer = render_answer(data, q_id)
+        render_cache.set_answer(data.generation, q_id, answer)
+    return answer
+
+
+async def _navigate(
+    query: CallbackQuery, text_kwargs: dict, kb: InlineKeyboardMarkup | None
+):
+    message = query.message
+    if (
+        NAVIGATION_MODE == NAVIGATION_MODES.EDIT.value
+        and isinstance(message, Message)
+        and message.text is not None
+    ):
+        try:
+            return await message.edit_text(**text_kwargs, reply_markup=kb)
+        except TelegramBadRequest as ex:
+            if "message is not modified" in ex.message:
+                return
+            # too old or otherwise not editable message, send a new one instead
+            logger.debug("cant edit message %s: %s", message.message_id, ex.message)
+    await message.answer(**text_kwargs, reply_markup=kb)
 
 
 # === User ===
 @users_router.message(CommandStart())
 async def start_cmd(message: Message, state: FSMContext):
-    text, kb = _generate_kb()
+    data = questions_data.SNAPSHOT
+    text, kb = _generate_kb(data)
     await message.answer(
-        text=msg_texts.TEXTS[TEXTS_LABELS.START.value] + "\n\n" + text, reply_markup=kb
+        text=data.texts[TEXTS_LABELS.START.value] + "\n\n" + text, reply_markup=kb
     )
 
 
-@users_router.callback_query(lambda q: q.data.startswith("go_by_id:"))
-async def go_to_callback(query: CallbackQuery, state: FSMContext):
-    param_id = int(query.data.split(":")[1])
-    if param_id < 0:
-        question = questions_data.QUESTIONS[param_id]["question"]
-        answer = questions_data.QUESTIONS[param_id]["answer"]
-        text = Text(BlockQuote(question), "\n\n", answer)
-        await query.message.answer(
-            **text.as_kwargs(), reply_markup=_get_back_kb(param_id)
-        )
-    else:
-        prefix = ""
-        if param_id != 0:
-            prefix = BlockQuote(questions_data.CATEGORIES[param_id]["name"]) + "\n\n"
-        text, kb = _generate_kb(parent_id=param_id)
-        await query.message.answer(
+@users_router.message(Command("search"))
+async def search_cmd(message: Message, command: CommandObject, state: FSMContext):
+    if not command.args:
+        return await message.answer(
             **Text(
-                prefix, msg_texts.TEXTS[TEXTS_LABELS.SELECT.value], "\n\n", text
-            ).as_kwargs(),
-            reply_markup=kb,
+                "Напишите запрос после команды, например: ",
+                Code("/search доставка"),
+            ).as_kwargs()
         )
-    await query.answer()
+
+    text, kb = _search_kb(questions_data.SNAPSHOT, command.args)
+    if kb is None:
+        return await message.answer(
+            **Text(Bold("По вашему запросу ничего не найдено")).as_kwargs()
+        )
+    await message.answer(
+        **Text(Bold("Результаты поиска:"), "\n\n", text).as_kwargs(),
+        reply_markup=kb,
+    )
 
 
-@users_router.callback_query(lambda q: q.data.startswith("back_by_id:"))
-async def back_to_callback(query: CallbackQuery, state: FSMContext):
-    param_id = int(query.data.split(":")[1])
-    parent_id = questions_data.get_item_parent(item_id=param_id)
-    text, kb = _generate_kb(parent_id=parent_id)
+async def _show_menu(
+    query: CallbackQuery, data: DataSnapshot, parent_id: int, page: int = 0
+):
     prefix = ""
     if parent_id != 0:
-        prefix = BlockQuote(questions_data.CATEGORIES[parent_id]["name"]) + "\n\n"
-    await query.message.answer(
-        **Text(
-            prefix, msg_texts.TEXTS[TEXTS_LABELS.SELECT.value], "\n\n", text
+        prefix = BlockQuote(data.categories[parent_id].name) + "\n\n"
+    text, kb = _generate_kb(data, parent_id=parent_id, page=page)
+    await _navigate(
+        query,
+        Text(
+            prefix, data.texts[TEXTS_LABELS.SELECT.value], "\n\n", text
         ).as_kwargs(),
-        reply_markup=kb,
+        kb,
+    )
+
+
+async def go_to_callback(
+    query: CallbackQuery, payload: NavCallback, data: DataSnapshot
+):
+    if payload.id < 0:
+        await _navigate(query, *_get_answer(data, payload.id))
+    else:
+        await _show_menu(query, data, parent_id=payload.id, page=payload.page)
+    await query.answer()
+
+
+async def back_to_callback(
+    query: CallbackQuery, payload: NavCallback, data: DataSnapshot
+):
+    await _show_menu(
+        query,
+        data,
+        parent_id=data.get_item_parent(item_id=payload.id),
+        page=item_page(data, item_id=payload.id),
     )
     await query.answer()
 
 
+# callback action -> handler
+NAV_HANDLERS = {
+    NAV_ACTIONS.GO: go_to_callback,
+    NAV_ACTIONS.BACK: back_to_callback,
+}
+
+
+@users_router.callback_query()
+async def callback_dispatch(query: CallbackQuery, state: FSMContext):
+    payload = decode_callback(query.data)
+    if payload is None or not isinstance(query.message, Message):
+        # inline mode messages have no menu to navigate in
+        return await all_callback(query, state)
+
+    data = questions_data.SNAPSHOT
+    node_exists = (
+        payload.id == 0
+        or payload.id in data.categories
+        or payload.id in data.questions
+    )
+    if not node_exists:
+        # the node was removed by a data update after the button was sent
+        logger.info(
+            "Stale callback for node %s (data generation %s)",
+            payload.id,
+            data.generation,
+        )
+        await _show_menu(query, data, parent_id=0)
+        return await query.answer("Этот пункт больше не существует, меню обновлено")
+
+    await NAV_HANDLERS[payload.action](query, payload, data)
+
+
+# === Inline ===
+def _inline_results(data: DataSnapshot, query: str) -> list:
+    key = (data.generation, query.strip().lower())
+    results = inline_results_cache.get(key)
+    if results is not None:
+        return results
+
+    results = []
+    found = data.search_index.search(
+        query, limit=INLINE_RESULTS_LIMIT, only_questions=True
+    )
+    for q_id in found:
+        question = data.questions[q_id].question
+        answer = data.questions[q_id].answer
+        # one result over the limit makes telegram reject the whole answer
+        room = MESSAGE_TEXT_LIMIT - text_length(question) - 2
+        text = Text(BlockQuote(question), "\n\n", shorten(answer, max(room, 1)))
+        results.append(
+            InlineQueryResultArticle(
+                id=str(q_id),
+                title=question,
+                description=answer[:100],
+                input_message_content=InputTextMessageContent(
+                    **text.as_kwargs(text_key="message_text")
+                ),
+            )
+        )
+    inline_results_cache.set(key, results)
+    return results
+
+
+@inline_router.inline_query()
+async def inline_search(inline_query: InlineQuery):
+    results = []
+    if inline_query.query.strip():
+        results = _inline_results(questions_data.SNAPSHOT, inline_query.query)
+    await inline_query.answer(
+        results, cache_time=INLINE_CACHE_TIME, is_personal=False
+    )
+
+
 @admins_router.message(Command("update"))
 async def update_cmd(message: Message, state: FSMContext):
     if not message.document:
@@ -170,7 +283,7 @@ async def update_cmd(message: Message, state: FSMContext):
             ).as_kwargs()
         )
         await message.answer_document(
-            document=FSInputFile(path="data.json", filename="data.json"),
+            document=FSInputFile(path=JSON_DATA_PATH, filename="data.json"),
             caption="текущий файл",
         )
         return
@@ -181,19 +294,24 @@ async def update_cmd(message: Message, state: FSMContext):
             **Text(Bold("Файл должен быть в формате .json")).as_kwargs()
         )
 
+    if (message.document.file_size or 0) > DATA_MAX_SIZE:
+        await message.answer("❌")
+        return await message.answer(
+            **Text(
+                Bold(f"Файл больше допустимых {DATA_MAX_SIZE // 1024 // 1024} МБ")
+            ).as_kwargs()
+        )
+
     try:
         file = await message.bot.download(file=message.document.file_id)
-        data = file.read()
-        json_data = json.loads(data)
-        parse_json(json_data)
-        back_path = backup_file(JSON_DATA_PATH, "data_backups/")
-        with open(JSON_DATA_PATH, "wb") as new_file:
-            new_file.write(data)
-    except JSONDecodeError:
+        back_path = await update_json_data(file.read())
+    except JSONDecodeError as ex:
         await message.answer("❌")
         return await message.answer(
             **Text(
-                Bold("Ошибка при чтении json файла (неверный синтаксис)")
+                Bold("Ошибка при чтении json файла (неверный синтаксис)"),
+                "\n\n",
+                Code(str(ex)),
             ).as_kwargs()
         )
     except DataParseException as ex:
@@ -203,16 +321,87 @@ async def update_cmd(message: Message, state: FSMContext):
     await json_updated_notify(message.from_user, backup_path=back_path)
 
 
+@admins_router.message(Command("rollback"))
+async def rollback_cmd(message: Message, command: CommandObject, state: FSMContext):
+    entries = await run_in_data_thread(backup_store.entries)
+    if not entries:
+        return await message.answer(
+            **Text(Bold("Резервных копий пока нет")).as_kwargs()
+        )
+
+    if not command.args:
+        lines = [
+            f"{number}. {entry['created']} ({entry['size']} байт)\n"
+            for number, entry in enumerate(entries, start=1)
+        ]
+        return await message.answer(
+            **Text(
+                Bold("Резервные копии (новые сверху):"),
+                "\n\n",
+                *lines,
+                "\nДля восстановления: ",
+                Code("/rollback 1"),
+            ).as_kwargs()
+        )
+
+    try:
+        number = int(command.args.strip())
+        raw_data = await run_in_data_thread(backup_store.get, number)
+    except (ValueError, IndexError):
+        await message.answer("❌")
+        return await message.answer(
+            **Text(
+                Bold(f"Номер копии должен быть от 1 до {len(entries)}")
+            ).as_kwargs()
+        )
+
+    try:
+        back_path = await update_json_data(raw_data)
+    except JSONDecodeError:
+        await message.answer("❌")
+        return await message.answer(
+            **Text(Bold("Резервная копия повреждена (неверный синтаксис)")).as_kwargs()
+        )
+    except DataParseException as ex:
+        logger.warning("cant parse json file from backup error")
+        return await json_format_error_notify(err_txt=ex.detail)
+
+    await json_updated_notify(message.from_user, backup_path=back_path)
+
+
+@admins_router.message(Command("stats"))
+async def stats_cmd(message: Message, state: FSMContext):
+    await message.answer(
+        **Text(Bold("Статистика"), "\n\n", Pre("\n".join(stats_lines()))).as_kwargs()
+    )
+
+
 @users_router.message()
 async def all_msg(message: Message, state: FSMContext):
-    logger.info(f"Unhandled msg update {message}")
-    await message.answer(text=msg_texts.TEXTS[TEXTS_LABELS.UNKNOWN.value])
+    if message.text:
+        text, kb = _search_kb(questions_data.SNAPSHOT, message.text)
+        if kb is not None:
+            return await message.answer(
+                **Text(Bold("Возможно, вы искали:"), "\n\n", text).as_kwargs(),
+                reply_markup=kb,
+            )
+
+    logger.info("Unhandled msg update in chat %s", message.chat.id)
+    if LOG_UPDATE_PAYLOADS:
+        logger.debug("Unhandled msg payload: %r", message)
+    await message.answer(
+        text=questions_data.SNAPSHOT.texts[TEXTS_LABELS.UNKNOWN.value]
+    )
     await start_cmd(message, state)
 
 
-@users_router.callback_query()
 async def all_callback(query: CallbackQuery, state: FSMContext):
-    logger.info(f"Unhandled callback update {query.message}")
-    await query.message.answer(text=msg_texts.TEXTS[TEXTS_LABELS.UNKNOWN.value])
-    await start_cmd(query.message, state)
+    # unknown or malformed callback data, e.g. a button of an old bot version
+    logger.info("Unhandled callback update from user %s", query.from_user.id)
+    if LOG_UPDATE_PAYLOADS:
+        logger.debug("Unhandled callback payload: %r", query)
+    data = questions_data.SNAPSHOT
+    if isinstance(query.message, Message):
+        await _show_menu(query, data, parent_id=0)
+    await query.answer(data.texts[TEXTS_LABELS.UNKNOWN.value], show_alert=True)
 
@@ -0,0 +1,241 @@
+import codecs
+import re
+from json import JSONDecodeError
+from json.decoder import scanstring
+from json.scanner import NUMBER_RE
+from typing import BinaryIO, Iterator
+
+WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+LITERALS = {"true": True, "false": False, "null": None}
+CHUNK_SIZE = 1 << 16
+# столько символов должно быть в буфере, чтобы число или литерал не оборвались
+LOOKAHEAD = 64
+
+# parser states
+VALUE, VALUE_OR_END, KEY, KEY_OR_END, AFTER_VALUE = range(5)
+
+
+class JsonStreamError(JSONDecodeError):
+    """Syntax error with the line, column and json path where it was found"""
+
+    def __init__(self, msg: str, lineno: int, colno: int, path: str = ""):
+        detail = f"{msg}: line {lineno} column {colno}"
+        if path:
+            detail += f" (path: {path})"
+        ValueError.__init__(self, detail)
+        self.msg = msg
+        self.doc = None
+        self.pos = None
+        self.lineno = lineno
+        self.colno = colno
+        self.path = path
+
+
+class JsonStreamParser:
+    """Incremental json tokenizer over a binary file, without recursion"""
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        max_size: int,
+        max_depth: int,
+        chunk_size: int = CHUNK_SIZE,
+    ):
+        self.file = file
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.size = 0
+        # position of the dropped part of the buffer, for error messages
+        self.lines_before = 0
+        self.columns_before = 0
+        # kinds of open containers and the key/index inside each of them
+        self.stack: list[str] = []
+        self.path: list = []
+
+    def where(self, pos: int | None = None) -> tuple[int, int]:
+        pos = self.pos if pos is None else pos
+        line = self.lines_before + self.buf.count("\n", 0, pos) + 1
+        newline = self.buf.rfind("\n", 0, pos)
+        if newline < 0:
+            return line, self.columns_before + pos + 1
+        return line, pos - newline
+
+    def path_str(self) -> str:
+        return " > ".join(str(item) for item in self.path if item is not None)
+
+    def error(self, msg: str, pos: int | None = None) -> JsonStreamError:
+        return JsonStreamError(msg, *self.where(pos), path=self.path_str())
+
+    def _compact(self):
+        dropped = self.buf[: self.pos]
+        newlines = dropped.count("\n")
+        if newlines:
+            self.lines_before += newlines
+            self.columns_before = len(dropped) - dropped.rfind("\n") - 1
+        else:
+            self.columns_before += len(dropped)
+        self.buf = self.buf[self.pos :]
+        self.pos = 0
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        if self.pos > self.chunk_size:
+            self._compact()
+        data = self.file.read(self.chunk_size)
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise self.error(f"file is larger than {self.max_size} bytes")
+        try:
+            self.buf += self.decoder.decode(data, final=not data)
+        except UnicodeDecodeError:
+            raise self.error("file is not valid utf-8")
+        if not data:
+            self.eof = True
+        return True
+
+    def _ensure(self, count: int):
+        while len(self.buf) - self.pos < count and self._fill():
+            pass
+
+    def _peek(self) -> str:
+        while True:
+            self.pos = WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos : self.pos + 1]
+
+    def _read_string(self) -> str:
+        while True:
+            try:
+                value, end = scanstring(self.buf, self.pos + 1)
+            except JSONDecodeError as ex:
+                # the string or an escape in it may continue in the next chunk
+                if not self.eof and (
+                    ex.msg.startswith("Unterminated") or ex.pos >= len(self.buf) - 6
+                ):
+                    self._fill()
+                    continue
+                raise self.error(ex.msg, ex.pos)
+            self.pos = end
+            return value
+
+    def _read_scalar(self):
+        if self.buf[self.pos] == '"':
+            return self._read_string()
+
+        self._ensure(LOOKAHEAD)
+        match = NUMBER_RE.match(self.buf, self.pos)
+        while match is not None and match.end() == len(self.buf) and self._fill():
+            match = NUMBER_RE.match(self.buf, self.pos)
+        if match is not None:
+            integer, frac, exp = match.groups()
+            self.pos = match.end()
+            if frac or exp:
+                return float(integer + (frac or "") + (exp or ""))
+            return int(integer)
+
+        for literal, value in LITERALS.items():
+            if self.buf.startswith(literal, self.pos):
+                self.pos += len(literal)
+                return value
+        raise self.error("Expecting value")
+
+    def _push(self, kind: str):
+        if len(self.stack) >= self.max_depth:
+            raise self.error(f"nesting is deeper than {self.max_depth} levels")
+        self.stack.append(kind)
+        self.path.append(0 if kind == "array" else None)
+        self.pos += 1
+
+    def _pop(self) -> str:
+        self.pos += 1
+        self.path.pop()
+        return "end_" + self.stack.pop()
+
+    def events(self) -> Iterator[tuple[str, object]]:
+        """Yields (event, value): start_map, end_map, start_array, end_array,
+        key and value (for strings, numbers, true, false and null)"""
+        state = VALUE
+        while True:
+            char = self._peek()
+            if state in (VALUE, VALUE_OR_END):
+                if state == VALUE_OR_END and char == "]":
+                    state = AFTER_VALUE
+                    yield self._pop(), None
+                elif char == "{":
+                    self._push("map")
+                    state = KEY_OR_END
+                    yield "start_map", None
+                elif char == "[":
+                    self._push("array")
+                    state = VALUE_OR_END
+                    yield "start_array", None
+                elif not char:
+                    raise self.error("Expecting value, got end of file")
+                else:
+                    value = self._read_scalar()
+                    state = AFTER_VALUE
+                    yield "value", value
+            elif state in (KEY, KEY_OR_END):
+                if state == KEY_OR_END and char == "}":
+                    state = AFTER_VALUE
+                    yield self._pop(), None
+                    continue
+                if char != '"':
+                    raise self.error(
+                        "Expecting property name enclosed in double quotes"
+                    )
+                key = self._read_string()
+                if self._peek() != ":":
+                    raise self.error("Expecting ':' delimiter")
+                self.pos += 1
+                self.path[-1] = key
+                state = VALUE
+                yield "key", key
+            elif not self.stack:
+                if char:
+                    raise self.error("Extra data")
+                return
+            elif char == ",":
+                self.pos += 1
+                if self.stack[-1] == "map":
+                    state = KEY
+                else:
+                    self.path[-1] += 1
+                    state = VALUE
+            elif char == ("}" if self.stack[-1] == "map" else "]"):
+                yield self._pop(), None
+            else:
+                raise self.error("Expecting ',' delimiter")
+
+    def read_value(self, events: Iterator[tuple[str, object]]):
+        """Builds the next value of the stream as plain python objects"""
+        containers = []
+        key = None
+        for event, value in events:
+            if event == "key":
+                key = value
+                continue
+            if event in ("end_map", "end_array"):
+                value = containers.pop()
+                if not containers:
+                    return value
+                continue
+            if event == "start_map":
+                value = {}
+            elif event == "start_array":
+                value = []
+            if containers:
+                if isinstance(containers[-1], dict):
+                    containers[-1][key] = value
+                else:
+                    containers[-1].append(value)
+            if event in ("start_map", "start_array"):
+                containers.append(value)
+            elif not containers:
+                return value
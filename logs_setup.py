@@ -1,10 +1,16 @@
+import atexit
 import logging
 import logging.config
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
 from enum import Enum
 
 from datetime import datetime
 
+from dotenv import load_dotenv
+
 
 class LogFiles(Enum):
     ALL = "logs/all.log"  # путь до файла debug логирования
@@ -12,8 +18,16 @@ class LogFiles(Enum):
     ERROR = "logs/err_warn.log"  # путь до файла логирования ошибок
 
 
+# logs_setup is imported before config, so .env is read here as well
+load_dotenv()
+
 # уровень логирования в консоль
-CONSOLE_LOGGING_LEVEL = "DEBUG"
+CONSOLE_LOGGING_LEVEL = os.getenv("CONSOLE_LOGGING_LEVEL", "DEBUG")
+# ротация: debug лог по размеру, остальные раз в сутки
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+os.makedirs(os.path.dirname(LogFiles.ALL.value), exist_ok=True)
 # Настройка формата логирования
 LOGGING_SETUP = {
     "version": 1,
@@ -27,20 +41,29 @@ LOGGING_SETUP = {
     "handlers": {
         "all_file": {
             "level": "DEBUG",
-            "class": "logging.FileHandler",
+            "class": "logging.handlers.RotatingFileHandler",
             "filename": LogFiles.ALL.value,
+            "maxBytes": LOG_MAX_BYTES,
+            "backupCount": LOG_BACKUP_COUNT,
+            "encoding": "utf-8",
             "formatter": "log_formatter",
         },
         "info_file": {
             "level": "INFO",
-            "class": "logging.FileHandler",
+            "class": "logging.handlers.TimedRotatingFileHandler",
             "filename": LogFiles.INFO.value,
+            "when": "midnight",
+            "backupCount": LOG_BACKUP_COUNT,
+            "encoding": "utf-8",
             "formatter": "log_formatter",
         },
         "error_file": {
             "level": "WARNING",
-            "class": "logging.FileHandler",
+            "class": "logging.handlers.TimedRotatingFileHandler",
             "filename": LogFiles.ERROR.value,
+            "when": "midnight",
+            "backupCount": LOG_BACKUP_COUNT,
+            "encoding": "utf-8",
             "formatter": "log_formatter",
         },
         "console": {
@@ -56,17 +79,35 @@ LOGGING_SETUP = {
             "propagate": False,
         },
     },
+    # логи библиотек (aiogram, aiohttp) пишутся только в общий файл
+    "root": {
+        "handlers": ["all_file"],
+        "level": "DEBUG",
+    },
 }
 
 
+class LazyQueueHandler(QueueHandler):
+    """Passes records to the listener thread without formatting them"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def _move_to_queue(target: logging.Logger) -> QueueListener:
+    # file and console handlers are served by a background thread
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *target.handlers, respect_handler_level=True)
+    target.handlers = [LazyQueueHandler(log_queue)]
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
 # Logging setup
 logging.config.dictConfig(LOGGING_SETUP)
-logging.basicConfig(
-    format="[%(asctime)s][%(levelname)s] ::: %(filename)s(%(lineno)d) -> %(message)s",
-    level="DEBUG",
-    filename=LogFiles.ALL.value,
-)
 logger = logging.getLogger("logger")
+_listeners = [_move_to_queue(logger), _move_to_queue(logging.getLogger())]
 
 
 def new_session_log():
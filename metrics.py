@@ -0,0 +1,242 @@
+import asyncio
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject
+
+from config import METRICS_HOST, METRICS_PORT
+from logs_setup import logger
+
+# границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# окно для подсчета апдейтов в минуту
+THROUGHPUT_WINDOW = 60
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        # last slot is for values above the largest bucket
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the quantile
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def average(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+
+class Metrics:
+    """In-process counters and latency histograms of the bot"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.handler_latency: dict[str, Histogram] = defaultdict(Histogram)
+        self.handler_errors: dict[str, int] = defaultdict(int)
+        self.api_latency: dict[str, Histogram] = defaultdict(Histogram)
+        self.api_errors: dict[str, int] = defaultdict(int)
+        self.data_load_latency: dict[str, Histogram] = defaultdict(Histogram)
+        self.updates: dict[str, int] = defaultdict(int)
+        self.in_flight = 0
+        # per second update counts over the last THROUGHPUT_WINDOW seconds
+        self.recent = [0] * THROUGHPUT_WINDOW
+        self.recent_second = 0
+        # name -> callable returning {counter: value} of other components
+        self.sources: dict[str, Callable[[], dict]] = {}
+
+    def add_source(self, name: str, stats: Callable[[], dict]):
+        self.sources[name] = stats
+
+    def count_update(self, update_type: str):
+        self.updates[update_type] += 1
+        second = int(time.monotonic())
+        if second != self.recent_second:
+            # zero the slots of the seconds without updates
+            for skipped in range(
+                max(self.recent_second + 1, second - THROUGHPUT_WINDOW + 1), second + 1
+            ):
+                self.recent[skipped % THROUGHPUT_WINDOW] = 0
+            self.recent_second = second
+        self.recent[second % THROUGHPUT_WINDOW] += 1
+
+    def updates_last_minute(self) -> int:
+        second = int(time.monotonic())
+        if second - self.recent_second >= THROUGHPUT_WINDOW:
+            return 0
+        return sum(
+            self.recent[s % THROUGHPUT_WINDOW]
+            for s in range(second - THROUGHPUT_WINDOW + 1, self.recent_second + 1)
+        )
+
+    def uptime(self) -> float:
+        return time.monotonic() - self.started
+
+
+metrics = Metrics()
+
+
+class InstrumentationMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        metrics.count_update(type(event).__name__)
+        metrics.in_flight += 1
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.handler_errors[name] += 1
+            raise
+        finally:
+            metrics.handler_latency[name].observe(time.perf_counter() - start)
+            metrics.in_flight -= 1
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            metrics.api_errors[name] += 1
+            raise
+        finally:
+            metrics.api_latency[name].observe(time.perf_counter() - start)
+
+
+api_metrics = ApiMetricsMiddleware()
+
+
+def _latency_summary(name: str, histogram: Histogram, errors: int) -> str:
+    return (
+        f"{name}: {histogram.count}, avg {histogram.average() * 1000:.1f} ms, "
+        f"p95 <= {histogram.quantile(0.95) * 1000:.0f} ms, errors {errors}"
+    )
+
+
+def stats_lines() -> list[str]:
+    uptime = int(metrics.uptime())
+    lines = [
+        f"uptime: {uptime // 3600}h {uptime % 3600 // 60}m",
+        f"updates: {sum(metrics.updates.values())}, "
+        f"last minute: {metrics.updates_last_minute()}, "
+        f"in flight: {metrics.in_flight}",
+        "",
+        "handlers:",
+    ]
+    for name, histogram in sorted(metrics.handler_latency.items()):
+        lines.append(
+            _latency_summary(name, histogram, metrics.handler_errors.get(name, 0))
+        )
+    lines += ["", "api:"]
+    for name, histogram in sorted(metrics.api_latency.items()):
+        lines.append(_latency_summary(name, histogram, metrics.api_errors.get(name, 0)))
+    lines += ["", "data load:"]
+    for name, histogram in sorted(metrics.data_load_latency.items()):
+        lines.append(_latency_summary(name, histogram, 0))
+    lines.append("")
+    for source, stats in metrics.sources.items():
+        counters = ", ".join(f"{key}={value}" for key, value in stats().items())
+        lines.append(f"{source}: {counters}")
+    return lines
+
+
+def _histogram_lines(name: str, label: str, histograms: dict) -> list[str]:
+    lines = [f"# TYPE {name} histogram"]
+    for key, histogram in sorted(histograms.items()):
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{label}="{key}",le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{{label}="{key}",le="+Inf"}} {histogram.count}')
+        lines.append(f'{name}_sum{{{label}="{key}"}} {histogram.sum}')
+        lines.append(f'{name}_count{{{label}="{key}"}} {histogram.count}')
+    return lines
+
+
+def _counter_lines(name: str, label: str, counters: dict) -> list[str]:
+    lines = [f"# TYPE {name} counter"]
+    for key, value in sorted(counters.items()):
+        lines.append(f'{name}{{{label}="{key}"}} {value}')
+    return lines
+
+
+def prometheus_text() -> str:
+    lines = []
+    lines += _histogram_lines(
+        "bot_handler_duration_seconds", "handler", metrics.handler_latency
+    )
+    lines += _counter_lines(
+        "bot_handler_errors_total", "handler", metrics.handler_errors
+    )
+    lines += _histogram_lines(
+        "bot_api_request_duration_seconds", "method", metrics.api_latency
+    )
+    lines += _counter_lines("bot_api_errors_total", "method", metrics.api_errors)
+    lines += _histogram_lines(
+        "bot_data_load_duration_seconds", "stage", metrics.data_load_latency
+    )
+    lines += _counter_lines("bot_updates_total", "type", metrics.updates)
+    lines += [
+        "# TYPE bot_handlers_in_flight gauge",
+        f"bot_handlers_in_flight {metrics.in_flight}",
+        "# TYPE bot_uptime_seconds gauge",
+        f"bot_uptime_seconds {metrics.uptime():.0f}",
+    ]
+    for source, stats in metrics.sources.items():
+        for key, value in stats().items():
+            lines.append(f"bot_{source}_{key} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def _metrics_view(request: web.Request) -> web.Response:
+    return web.Response(text=prometheus_text(), content_type="text/plain")
+
+
+async def run_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=METRICS_HOST, port=METRICS_PORT).start()
+    logger.info("Metrics endpoint listening on %s:%s", METRICS_HOST, METRICS_PORT)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -1,4 +1,3 @@
-import asyncio
 from typing import Callable, Dict, Any, Awaitable
 
 from aiogram import BaseMiddleware
@@ -6,10 +5,13 @@ from aiogram.types import CallbackQuery, Message, ChatMemberUpdated
 
 from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
 
-from utils import notify_admins_about_error
+from utils import notify_admins_about_error, LRUCache
 
 from app import logger
+from config import THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAX_USERS
+from filters import IsAdminFilter
 
+import time
 import traceback
 
 
@@ -37,27 +39,84 @@ class ErrorMiddleware(BaseMiddleware):
             result = await handler(event, data)
             return result
         except TelegramRetryAfter as ex:
+            # retries are done by the outbound rate limiter, rerunning the
+            # handler here would only send duplicate messages
             logger.warning(
-                f"Flood control by API in telegram bot warning try in: {ex.retry_after} seconds"
+                "Flood control by API is not over after retries: %s seconds",
+                ex.retry_after,
             )
-            await asyncio.sleep(ex.retry_after + 10)
-            return await handler(event, data)
         except TelegramAPIError as ex:
             if "message is not modified" in str(ex.message):
-                await event.answer()
+                # repeated tap on the same button, only the spinner needs stopping
+                if isinstance(event, CallbackQuery):
+                    await event.answer()
                 return
             logger.error("Telegram API error while handling event", exc_info=True)
             await notify_admins_about_error(
                 str(ex.label),
-                traceback.format_exc(limit=4).splitlines(),
+                traceback.format_exc(limit=-4).splitlines(),
                 event.from_user,
+                background=True,
             )
             await answer_event(event)
         except Exception as ex:
             logger.error("Error while handling event", exc_info=True)
             await notify_admins_about_error(
                 str(type(ex).__name__),
-                traceback.format_exc(limit=4).splitlines(),
+                traceback.format_exc(limit=-4).splitlines(),
                 event.from_user,
+                background=True,
             )
             await answer_event(event)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(
+        self,
+        rate: float = THROTTLE_RATE,
+        burst: int = THROTTLE_BURST,
+        max_users: int = THROTTLE_MAX_USERS,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        # user_id -> (tokens, last update time), least active users are dropped
+        self.buckets = LRUCache(maxsize=max_users)
+        self.admin_filter = IsAdminFilter(is_admin=True)
+        self.passed = 0
+        self.throttled = 0
+
+    def stats(self) -> dict:
+        return {
+            "passed": self.passed,
+            "throttled": self.throttled,
+            "users": len(self.buckets),
+        }
+
+    def _take_token(self, user_id: int) -> bool:
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets.set(user_id, (tokens, now))
+            return False
+        self.buckets.set(user_id, (tokens - 1, now))
+        return True
+
+    async def __call__(
+        self,
+        handler: Callable[[CallbackQuery | Message, Dict[str, Any]], Awaitable[Any]],
+        event: CallbackQuery | Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        if event.from_user is None or await self.admin_filter(event):
+            return await handler(event, data)
+
+        if not self._take_token(event.from_user.id):
+            self.throttled += 1
+            if isinstance(event, CallbackQuery):
+                # stops the loading spinner on the pressed button
+                await event.answer()
+            return
+
+        self.passed += 1
+        return await handler(event, data)
@@ -0,0 +1,119 @@
+import asyncio
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from config import (
+    RATE_LIMIT_GLOBAL,
+    RATE_LIMIT_PRIVATE_CHAT,
+    RATE_LIMIT_GROUP_CHAT,
+    RATE_LIMIT_CHAT_BURST,
+    RATE_LIMIT_MAX_RETRIES,
+)
+from logs_setup import logger
+from metrics import metrics
+
+# сколько корзин чатов держать до чистки неактивных
+MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    """Virtual scheduling bucket: callers reserve the next free send slot"""
+
+    __slots__ = ("interval", "tolerance", "next_free", "paused_until")
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1 / rate
+        self.tolerance = self.interval * (burst - 1)
+        self.next_free = 0.0
+        self.paused_until = 0.0
+
+    def reserve(self, now: float) -> float:
+        # returns how long the caller has to wait for its slot
+        start = max(self.next_free - self.tolerance, self.paused_until, now)
+        self.next_free = max(self.next_free, start) + self.interval
+        return start - now
+
+    def pause(self, now: float, delay: float):
+        self.paused_until = max(self.paused_until, now + delay)
+
+    def is_idle(self, now: float) -> bool:
+        return self.next_free <= now and self.paused_until <= now
+
+
+class OutboundRateLimiter(BaseRequestMiddleware):
+    def __init__(self):
+        self.global_bucket = TokenBucket(RATE_LIMIT_GLOBAL, burst=RATE_LIMIT_GLOBAL)
+        self.chat_buckets: dict[int | str, TokenBucket] = {}
+        self.retries = 0
+        self.delayed = 0
+
+    def _chat_bucket(self, chat_id: int | str, now: float) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                self.chat_buckets = {
+                    key: value
+                    for key, value in self.chat_buckets.items()
+                    if not value.is_idle(now)
+                }
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = RATE_LIMIT_GROUP_CHAT if is_group else RATE_LIMIT_PRIVATE_CHAT
+            bucket = TokenBucket(rate, burst=RATE_LIMIT_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def stats(self) -> dict:
+        return {
+            "retries": self.retries,
+            "delayed": self.delayed,
+            "chat_buckets": len(self.chat_buckets),
+        }
+
+    async def _wait(self, bucket: TokenBucket):
+        delay = bucket.reserve(asyncio.get_running_loop().time())
+        if delay > 0:
+            self.delayed += 1
+            await asyncio.sleep(delay)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        # limits apply only to messages sent into chats, not to polling/answers
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            chat_bucket = self._chat_bucket(chat_id, loop.time())
+            await self._wait(chat_bucket)
+            await self._wait(self.global_bucket)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as ex:
+                attempt += 1
+                if attempt > RATE_LIMIT_MAX_RETRIES:
+                    raise
+                self.retries += 1
+                logger.warning(
+                    "Flood control for chat %s, pausing it for %s seconds",
+                    chat_id,
+                    ex.retry_after,
+                )
+                chat_bucket.pause(loop.time(), ex.retry_after)
+
+
+# общий для всех экземпляров Bot, чтобы лимиты считались вместе
+outbound_limiter = OutboundRateLimiter()
+metrics.add_source("outbound", outbound_limiter.stats)
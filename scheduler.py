@@ -0,0 +1,190 @@
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Update
+
+from config import (
+    UPDATE_WORKERS,
+    UPDATE_QUEUE_SIZE,
+    UPDATE_CHAT_QUEUE_SIZE,
+    UPDATE_DRAIN_TIMEOUT,
+)
+from logs_setup import logger
+from metrics import metrics
+
+
+class UpdateScheduler(BaseMiddleware):
+    """Runs updates on a fixed pool of workers, strictly in order within a chat"""
+
+    def __init__(
+        self,
+        workers: int = UPDATE_WORKERS,
+        max_pending: int = UPDATE_QUEUE_SIZE,
+        max_chat_pending: int = UPDATE_CHAT_QUEUE_SIZE,
+    ):
+        self.workers_count = workers
+        self.max_pending = max_pending
+        self.max_chat_pending = max_chat_pending
+        # chat key -> updates waiting for it; a key stays here while its
+        # update is being handled, so the chat is never taken by two workers
+        self.chat_queues: dict[Hashable, deque] = {}
+        self.ready: asyncio.Queue | None = None
+        self.slots: asyncio.Semaphore | None = None
+        self.workers: list[asyncio.Task] = []
+        # set whenever nothing is queued or running, awaited on shutdown
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.closing = False
+        self.saturated = False
+        self.pending = 0
+        self.max_pending_seen = 0
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.backpressure_waits = 0
+        self.dropped = 0
+        # answers to dropped callback queries, kept until they are sent
+        self.drop_answers: set[asyncio.Task] = set()
+
+    def _start(self):
+        self.ready = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.max_pending)
+        self.workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers_count)
+        ]
+        logger.info("update scheduler started with %s workers", self.workers_count)
+
+    @staticmethod
+    def _chat_key(update: Update, data: Dict[str, Any]) -> Hashable:
+        chat = data.get("event_chat")
+        if chat is not None:
+            return chat.id
+        user = data.get("event_from_user")
+        if user is not None:
+            return user.id
+        # e.g. polls without a chat, they need no ordering
+        return ("update", update.update_id)
+
+    async def _worker(self):
+        while True:
+            key = await self.ready.get()
+            queue = self.chat_queues[key]
+            handler, update, data = queue.popleft()
+            self.in_flight += 1
+            try:
+                await handler(update, data)
+            except Exception:
+                self.failed += 1
+                logger.error(
+                    "Error while handling update %s", update.update_id, exc_info=True
+                )
+            finally:
+                self.in_flight -= 1
+                self.pending -= 1
+                self.processed += 1
+                self.slots.release()
+                if queue:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.chat_queues[key]
+                if self.pending == 0:
+                    self.drained.set()
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        if self.closing:
+            logger.warning("update %s received during shutdown", event.update_id)
+            return
+        if not self.workers:
+            self._start()
+
+        key = self._chat_key(event, data)
+        queue = self.chat_queues.get(key)
+        if queue is not None and len(queue) >= self.max_chat_pending:
+            # one flooding chat must not take the queue shared by everyone
+            self._drop(event)
+            return
+
+        if self.slots.locked():
+            # the caller (polling loop or webhook request) waits here, so no
+            # new updates are fetched until the workers catch up
+            self.backpressure_waits += 1
+            if not self.saturated:
+                self.saturated = True
+                logger.warning(
+                    "update queue is full (%s pending), applying backpressure",
+                    self.pending,
+                )
+        await self.slots.acquire()
+        if self.saturated and self.pending < self.max_pending // 2:
+            self.saturated = False
+            logger.info("update queue drained to %s pending", self.pending)
+
+        # the chat queue could be handled and removed while we were waiting
+        queue = self.chat_queues.get(key)
+        if queue is None:
+            queue = self.chat_queues[key] = deque()
+            self.ready.put_nowait(key)
+        queue.append((handler, event, data))
+        self.pending += 1
+        self.drained.clear()
+        self.max_pending_seen = max(self.max_pending_seen, self.pending)
+
+    def _drop(self, update: Update):
+        self.dropped += 1
+        logger.debug("update %s dropped, chat queue is full", update.update_id)
+        if update.callback_query is not None:
+            # stops the loading indicator on the pressed button
+            task = asyncio.create_task(self._answer_dropped(update.callback_query))
+            self.drop_answers.add(task)
+            task.add_done_callback(self.drop_answers.discard)
+
+    @staticmethod
+    async def _answer_dropped(query: CallbackQuery):
+        try:
+            await query.answer("Слишком много нажатий, подождите немного")
+        except Exception as ex:
+            logger.debug("cant answer dropped callback %s: %s", query.id, ex)
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self.workers),
+            "pending": self.pending,
+            "max_pending_seen": self.max_pending_seen,
+            "in_flight": self.in_flight,
+            "active_chats": len(self.chat_queues),
+            "processed": self.processed,
+            "failed": self.failed,
+            "backpressure_waits": self.backpressure_waits,
+            "dropped": self.dropped,
+        }
+
+    async def close(self, timeout: float = UPDATE_DRAIN_TIMEOUT):
+        # polling has already confirmed the queued updates to telegram, so
+        # they are handled before the workers stop
+        self.closing = True
+        try:
+            await asyncio.wait_for(self.drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "update scheduler stopped with %s updates not handled", self.pending
+            )
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.chat_queues = {}
+        self.pending = 0
+        self.in_flight = 0
+        self.drained.set()
+        self.closing = False
+
+
+update_scheduler = UpdateScheduler()
+metrics.add_source("scheduler", update_scheduler.stats)
@@ -0,0 +1,201 @@
+import heapq
+import re
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from functools import lru_cache
+
+WORD_RE = re.compile(r"\w+")
+
+# окончания для упрощенного стемминга русских слов
+RU_ENDINGS = frozenset(
+    (
+        "иями", "ией", "ии", "ию", "ями", "ами", "ого", "его", "ому", "ему",
+        "ыми", "ими", "ешь", "ить", "ать", "ять", "еть", "ть",
+        "ете", "ишь", "ите", "ает", "яет", "ют", "ут", "ят", "ат", "ее", "ие",
+        "ые", "ое", "ей", "ий", "ый", "ой", "ем", "им", "ым", "ом", "ах", "ях",
+        "ую", "юю", "ая", "яя", "ою", "ею", "ов", "ев", "ам", "ям", "ия", "ья",
+        "ью", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+    )
+)
+RU_ENDING_LENGTHS = sorted({len(ending) for ending in RU_ENDINGS}, reverse=True)
+MIN_STEM_LEN = 3
+STOP_WORDS = frozenset(
+    (
+        "а", "в", "во", "и", "к", "ко", "с", "со", "у", "о", "об", "на", "по",
+        "за", "из", "от", "до", "для", "не", "ни", "ли", "же", "бы", "то", "как",
+        "что", "это", "или", "но", "да", "мне", "мой", "я", "вы", "где", "когда",
+    )
+)
+
+# веса полей при ранжировании
+QUESTION_WEIGHT = 3.0
+CATEGORY_WEIGHT = 2.0
+ANSWER_WEIGHT = 1.0
+# частичные совпадения ценятся меньше точных
+PREFIX_FACTOR = 0.6
+FUZZY_FACTOR = 0.4
+
+# сколько лучших узлов каждого слова просматривается при поиске
+MAX_POSTINGS_SCAN = 100
+MIN_PREFIX_LEN = 3
+MAX_PREFIX_EXPANSIONS = 30
+MAX_FUZZY_EXPANSIONS = 10
+# сколько узлов всего набирается по всем расширениям одного слова
+MAX_EXPANSION_CANDIDATES = 200
+FUZZY_MIN_SIMILARITY = 0.3
+
+
+@lru_cache(maxsize=65536)
+def normalize_term(word: str) -> str:
+    word = word.lower().replace("ё", "е")
+    for length in RU_ENDING_LENGTHS:
+        if len(word) - length < MIN_STEM_LEN:
+            continue
+        if word[-length:] in RU_ENDINGS:
+            return word[:-length]
+    return word
+
+
+def tokenize(text: str) -> list[str]:
+    return [
+        normalize_term(word)
+        for word in WORD_RE.findall(text.lower())
+        if word not in STOP_WORDS
+    ]
+
+
+def trigrams(term: str) -> set[str]:
+    padded = f" {term} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """Inverted index over question texts, answers and category names"""
+
+    def __init__(self, postings: dict | None = None):
+        # term -> {node_id: weight}
+        self.postings = postings or {}
+        self.terms = sorted(self.postings)
+        # node ids of each term ordered by weight, used for capped scans;
+        # packed into arrays, which take a fraction of a list of int objects
+        self.ranked = {
+            term: array("q", sorted(node_weights, key=node_weights.get, reverse=True))
+            for term, node_weights in self.postings.items()
+        }
+        self.trigram_terms = defaultdict(list)
+        for term in self.terms:
+            for gram in trigrams(term):
+                self.trigram_terms[gram].append(term)
+
+    @classmethod
+    def build(cls, questions: dict, categories: dict) -> "SearchIndex":
+        postings = defaultdict(dict)
+
+        def add(node_id: int, text: str, weight: float):
+            for term in tokenize(text):
+                node_weights = postings[term]
+                node_weights[node_id] = node_weights.get(node_id, 0.0) + weight
+
+        for q_id, question in questions.items():
+            add(q_id, question.question, QUESTION_WEIGHT)
+            add(q_id, question.answer, ANSWER_WEIGHT)
+        for cat_id, category in categories.items():
+            # top level questions are already indexed by themselves
+            if category.is_category:
+                add(cat_id, category.name, CATEGORY_WEIGHT)
+
+        return cls(dict(postings))
+
+    def _prefix_terms(self, prefix: str) -> list[str]:
+        result = []
+        i = bisect_left(self.terms, prefix)
+        while i < len(self.terms) and len(result) < MAX_PREFIX_EXPANSIONS:
+            term = self.terms[i]
+            if not term.startswith(prefix):
+                break
+            if term != prefix:
+                result.append(term)
+            i += 1
+        return result
+
+    def _fuzzy_terms(self, term: str) -> list[tuple[str, float]]:
+        grams = trigrams(term)
+        shared = defaultdict(int)
+        for gram in grams:
+            for candidate in self.trigram_terms.get(gram, ()):
+                shared[candidate] += 1
+
+        scored = []
+        for candidate, count in shared.items():
+            # у слова из n букв (с паддингом) не больше n триграмм
+            similarity = count / (len(grams) + len(candidate) - count)
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                scored.append((candidate, similarity))
+        scored.sort(key=lambda x: x[1], reverse=True)
+        return scored[:MAX_FUZZY_EXPANSIONS]
+
+    def _term_weights(self, term: str) -> tuple[dict, list]:
+        prefixed = []
+        if len(term) >= MIN_PREFIX_LEN:
+            prefixed = self._prefix_terms(term)
+        if term in self.postings and not prefixed:
+            return self.postings[term], self.ranked[term][:MAX_POSTINGS_SCAN]
+
+        # the most frequent completions are the likeliest ones, they are
+        # scanned first while the candidate budget lasts
+        prefixed.sort(key=lambda t: len(self.postings[t]), reverse=True)
+        expansions = [(t, PREFIX_FACTOR) for t in prefixed]
+        if term in self.postings:
+            expansions.insert(0, (term, 1.0))
+        if not expansions and len(term) >= MIN_PREFIX_LEN:
+            expansions = [
+                (t, FUZZY_FACTOR * similarity)
+                for t, similarity in self._fuzzy_terms(term)
+            ]
+
+        weights = {}
+        for expansion, factor in expansions:
+            budget = MAX_EXPANSION_CANDIDATES - len(weights)
+            if budget <= 0:
+                break
+            node_weights = self.postings[expansion]
+            for node_id in self.ranked[expansion][: min(MAX_POSTINGS_SCAN, budget)]:
+                weight = node_weights[node_id] * factor
+                if weight > weights.get(node_id, 0.0):
+                    weights[node_id] = weight
+        return weights, list(weights)
+
+    def search(
+        self, query: str, limit: int = 10, only_questions: bool = False
+    ) -> list[int]:
+        term_weights = []
+        candidates = set()
+        for term in set(tokenize(query)):
+            weights, top = self._term_weights(term)
+            if weights:
+                term_weights.append(weights)
+                candidates.update(top)
+        if not term_weights:
+            return []
+
+        # the rarest term is scanned fully so nodes matching all terms are kept
+        rarest = min(term_weights, key=len)
+        if len(rarest) <= MAX_POSTINGS_SCAN:
+            candidates.update(rarest)
+        if only_questions:
+            candidates = {node_id for node_id in candidates if node_id < 0}
+
+        ranking = {}
+        for node_id in candidates:
+            matched = 0
+            score = 0.0
+            for weights in term_weights:
+                weight = weights.get(node_id)
+                if weight is not None:
+                    matched += 1
+                    score += weight
+            # больше совпавших слов запроса важнее суммарного веса
+            ranking[node_id] = (matched, score)
+
+        return heapq.nlargest(limit, ranking, key=ranking.get)
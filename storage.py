@@ -0,0 +1,200 @@
+import asyncio
+import json
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from itertools import islice
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (
+    BaseStorage,
+    DefaultKeyBuilder,
+    KeyBuilder,
+    StateType,
+    StorageKey,
+)
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import (
+    FSM_STORAGE,
+    FSM_STORAGES,
+    FSM_SQLITE_PATH,
+    FSM_FLUSH_INTERVAL,
+    FSM_CACHE_SIZE,
+    REDIS_URL,
+)
+from logs_setup import logger
+
+
+class SQLiteRecord:
+    __slots__ = ("state", "data")
+
+    def __init__(self, state: Optional[str] = None, data: Dict[str, Any] = None):
+        self.state = state
+        self.data = data or {}
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage on SQLite with a write-through cache and batched flushes"""
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval: float = 1.0,
+        cache_size: int = 100000,
+        key_builder: KeyBuilder | None = None,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self.cache: OrderedDict[str, SQLiteRecord] = OrderedDict()
+        # keys changed since the last flush
+        self.dirty: set[str] = set()
+        # every sqlite call runs in this single thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-db")
+        self.connection: sqlite3.Connection | None = None
+        self.flusher: asyncio.Task | None = None
+        self.flushes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS fsm "
+                "(key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL)"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def _load(self, key: str) -> SQLiteRecord:
+        row = (
+            self._connect()
+            .execute("SELECT state, data FROM fsm WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return SQLiteRecord()
+        return SQLiteRecord(row[0], json.loads(row[1]))
+
+    def _write(self, rows: list[tuple[str, Optional[str], Optional[str]]]):
+        connection = self._connect()
+        with connection:
+            for key, state, data in rows:
+                if state is None and data is None:
+                    connection.execute("DELETE FROM fsm WHERE key = ?", (key,))
+                else:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO fsm (key, state, data) "
+                        "VALUES (?, ?, ?)",
+                        (key, state, data),
+                    )
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def _record(self, key: StorageKey) -> tuple[str, SQLiteRecord]:
+        storage_key = self.key_builder.build(key)
+        record = self.cache.get(storage_key)
+        if record is None:
+            record = await self._run(self._load, storage_key)
+            # it could be set by another handler while we were loading it
+            record = self.cache.setdefault(storage_key, record)
+            self._evict()
+        self.cache.move_to_end(storage_key)
+        return storage_key, record
+
+    def _evict(self):
+        # only records that are already on disk can be dropped from memory,
+        # dirty ones are skipped and evicted after the next flush
+        excess = len(self.cache) - self.cache_size
+        if excess <= 0:
+            return
+        victims = []
+        # the newest record is the one being requested right now
+        for storage_key in islice(self.cache, len(self.cache) - 1):
+            if storage_key not in self.dirty:
+                victims.append(storage_key)
+                if len(victims) == excess:
+                    break
+        for storage_key in victims:
+            del self.cache[storage_key]
+
+    def _mark_dirty(self, storage_key: str):
+        self.dirty.add(storage_key)
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self.dirty:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        rows = []
+        for storage_key in self.dirty:
+            record = self.cache[storage_key]
+            if record.state is None and not record.data:
+                rows.append((storage_key, None, None))
+            else:
+                rows.append((storage_key, record.state, json.dumps(record.data)))
+        self.dirty = set()
+        await self._run(self._write, rows)
+        self.flushes += 1
+        self._evict()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key, record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(storage_key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, record = await self._record(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key, record = await self._record(key)
+        record.data = data.copy()
+        self._mark_dirty(storage_key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, record = await self._record(key)
+        return record.data.copy()
+
+    async def get_value(
+        self, storage_key: StorageKey, dict_key: str, default: Optional[Any] = None
+    ) -> Optional[Any]:
+        _, record = await self._record(storage_key)
+        return copy(record.data.get(dict_key, default))
+
+    async def close(self) -> None:
+        if self.flusher is not None:
+            self.flusher.cancel()
+        await self.flush()
+        if self.connection is not None:
+            await self._run(self.connection.close)
+            self.connection = None
+        self.executor.shutdown(wait=True)
+
+
+def create_storage() -> BaseStorage:
+    if FSM_STORAGE == FSM_STORAGES.SQLITE.value:
+        return SQLiteStorage(
+            FSM_SQLITE_PATH,
+            flush_interval=FSM_FLUSH_INTERVAL,
+            cache_size=FSM_CACHE_SIZE,
+        )
+    if FSM_STORAGE == FSM_STORAGES.REDIS.value:
+        # needs the redis package, which is only installed for this backend
+        from aiogram.fsm.storage.redis import RedisStorage
+
+        return RedisStorage.from_url(REDIS_URL)
+    if FSM_STORAGE != FSM_STORAGES.MEMORY.value:
+        logger.warning("unknown FSM_STORAGE %s, using memory storage", FSM_STORAGE)
+    return MemoryStorage()
@@ -1,31 +1,100 @@
+import asyncio
+import gzip
+import hashlib
+import io
 import json
+import mmap
 import os
-import shutil
+import pickle
+import stat
+import sys
+import tempfile
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from datetime import datetime
 from enum import Enum
+from functools import partial
+from json import JSONDecodeError
+from typing import BinaryIO
 
-from app import bot, msg_texts, questions_data
+from app import bot, questions_data, render_cache
 
+from callbacks import go_data, back_data
+from jsonstream import JsonStreamParser
 from logs_setup import logger
+from metrics import metrics
+from search import SearchIndex
 
 from config import (
     ADMINS,
+    BACKUPS_DIR,
+    BACKUPS_KEEP,
+    COMPILED_DATA_PATH,
+    DATA_WATCH_INTERVAL,
+    ADMIN_NOTIFY_CONCURRENCY,
+    ERROR_DIGEST_WINDOW,
+    ERROR_DIGEST_MAX_USERS,
     JSON_DATA_PATH,
+    MENU_PAGE_SIZE,
+    MESSAGE_TEXT_LIMIT,
     TEXTS_LABELS,
+    DATA_MAX_SIZE,
+    DATA_MAX_DEPTH,
+    DATA_MAX_NODES,
+    CategoryNode,
+    QuestionNode,
+    DataSnapshot,
 )
 
+try:
+    from watchfiles import awatch
+except ImportError:
+    awatch = None
+
 from aiogram.utils.formatting import Text, Pre, Bold, Italic, Code, BlockQuote
-from aiogram.types import InlineKeyboardMarkup, User, InputFile, FSInputFile
+from aiogram.types import (
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    User,
+    InputFile,
+    FSInputFile,
+)
 
 
-async def _notify_admins(
+# caps parallel admin deliveries across all notifications
+_admins_semaphore = asyncio.Semaphore(ADMIN_NOTIFY_CONCURRENCY)
+# references to fire-and-forget notifications, so they are not garbage collected
+_background_tasks = set()
+
+
+def _background_task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(
+            "background task %s failed", task.get_name(), exc_info=task.exception()
+        )
+
+
+def start_background_task(coro, name: str) -> asyncio.Task:
+    # for long running tasks, whose crash would otherwise go unnoticed
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+
+async def _notify_admin(
+    admin: int,
     contents: list[Text],
     reply_markup: InlineKeyboardMarkup | None = None,
     keyboard_message_index: int = 0,
     with_file: InputFile | None = None,
     file_message_index: int = 0,
 ):
-    for admin in ADMINS:
+    async with _admins_semaphore:
         try:
             for index, content in enumerate(contents):
                 if index == keyboard_message_index:
@@ -47,21 +116,113 @@ async def _notify_admins(
                     )
         except Exception as e:
             logger.warning(
-                f"error while sending message to admin : {admin}", exc_info=e
+                "error while sending message to admin : %s", admin, exc_info=e
             )
 
 
+async def _notify_admins(
+    contents: list[Text],
+    reply_markup: InlineKeyboardMarkup | None = None,
+    keyboard_message_index: int = 0,
+    with_file: InputFile | None = None,
+    file_message_index: int = 0,
+    background: bool = False,
+):
+    notifications = [
+        _notify_admin(
+            admin,
+            contents,
+            reply_markup=reply_markup,
+            keyboard_message_index=keyboard_message_index,
+            with_file=with_file,
+            file_message_index=file_message_index,
+        )
+        for admin in ADMINS
+    ]
+    if not background:
+        await asyncio.gather(*notifications)
+        return
+
+    task = asyncio.gather(*notifications)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
 async def startup_admins_notify():
     emoji_content = Text("🚀")
     content = Text("Бот запущен.")
     await _notify_admins([emoji_content, content])
 
 
+@dataclass
+class ErrorGroup:
+    label: str
+    count: int = 0
+    users: set = field(default_factory=set)
+    total: int = 1
+
+
+# signature -> errors of the same kind seen during the current digest window
+_error_groups: dict[str, ErrorGroup] = {}
+
+
+def _error_signature(error_label: str, error_message: list[str]) -> str:
+    # only frame lines are used, exception text often contains request data
+    frames = [line for line in error_message if line.lstrip().startswith("File ")]
+    return "\n".join([error_label, *frames])
+
+
+async def _error_digest_loop(signature: str):
+    while True:
+        await asyncio.sleep(ERROR_DIGEST_WINDOW)
+        group = _error_groups[signature]
+        if group.count == 0:
+            del _error_groups[signature]
+            return
+
+        sample = ", ".join(str(user_id) for user_id in list(group.users)[:5])
+        content = Text(
+            "🔁 Ошибка повторилась за последние ",
+            ERROR_DIGEST_WINDOW,
+            " сек.\n\n",
+            Bold(group.label),
+            "\n\n",
+            Italic("повторов: "),
+            Code(group.count),
+            "\n",
+            Italic("всего с начала серии: "),
+            Code(group.total),
+            "\n",
+            Italic("пользователей: "),
+            Code(len(group.users)),
+            "\n",
+            Italic("например user_id: "),
+            Code(sample),
+        )
+        group.count = 0
+        group.users = set()
+        await _notify_admins([content])
+
+
 async def notify_admins_about_error(
-    error_label: str, error_message: str | list, user: User
+    error_label: str, error_message: str | list, user: User, background: bool = False
 ):
-    if isinstance(error_message, list):
-        error_message = "\n".join(error_message)
+    if isinstance(error_message, str):
+        error_message = error_message.splitlines()
+    signature = _error_signature(error_label, error_message)
+    group = _error_groups.get(signature)
+    if group is not None:
+        # same error is already reported, it goes to the next digest
+        group.count += 1
+        group.total += 1
+        if len(group.users) < ERROR_DIGEST_MAX_USERS:
+            group.users.add(user.id)
+        return
+    _error_groups[signature] = ErrorGroup(label=error_label, users={user.id})
+    task = asyncio.create_task(_error_digest_loop(signature))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
     content = Text(
         "⚠️ Произошла неизвестная ошибка при работе бота\n\n",
         Italic("user_id: "),
@@ -75,9 +236,9 @@ async def notify_admins_about_error(
         "\n\n",
         Bold(error_label),
         "\n\n",
-        Pre(error_message),
+        Pre("\n".join(error_message)),
     )
-    await _notify_admins([content])
+    await _notify_admins([content], background=background)
 
 
 async def json_format_error_notify(err_txt: str = "Ошибка парсинга"):
@@ -93,7 +254,13 @@ async def json_format_error_notify(err_txt: str = "Ошибка парсинга
     await _notify_admins([emoji_content, content])
 
 
-async def json_updated_notify(user: User, backup_path: str = ""):
+async def json_updated_notify(user: User | None = None, backup_path: str = ""):
+    if user is None:
+        content = Text(
+            "🔄 Обновлен json файл на диске, новые данные загружены без перезапуска."
+        )
+        return await _notify_admins([content])
+
     content = Text(
         "🔄 Обновлен json файл пользователем:\n\n",
         Italic("user_id: "),
@@ -142,114 +309,810 @@ class TOP_LEVEL_LABELS(Enum):
     QUESTIONS = "questions"
 
 
-def parse_json(raw_json: dict):
+class NODE_KINDS(Enum):
+    CATEGORY = "c"
+    QUESTION = "q"
+    WRAPPER = "w"
+
+
+def make_node_id(kind: NODE_KINDS, path: tuple, taken_ids: set) -> int:
+    # id depends only on the node path, so editing one node keeps the others
+    salt = 0
+    while True:
+        key = "\x1f".join((kind.value, *path, str(salt)))
+        digest = hashlib.blake2b(key.encode(), digest_size=6).digest()
+        node_id = int.from_bytes(digest, "big")
+        if kind == NODE_KINDS.QUESTION:
+            node_id = -node_id
+        if node_id != 0 and node_id not in taken_ids:
+            taken_ids.add(node_id)
+            return node_id
+        salt += 1
+
+
+@dataclass(frozen=True)
+class SnapshotDiff:
+    added: set
+    removed: set
+    changed: set
+    # parents whose rendered menu is no longer valid
+    stale_menus: set
+
+
+def diff_snapshots(old: DataSnapshot, new: DataSnapshot) -> SnapshotDiff:
+    old_nodes = old.categories.keys() | old.questions.keys()
+    new_nodes = new.categories.keys() | new.questions.keys()
+    added = new_nodes - old_nodes
+    removed = old_nodes - new_nodes
+
+    changed = set()
+    for q_id in old.questions.keys() & new.questions.keys():
+        if old.questions[q_id] != new.questions[q_id]:
+            changed.add(q_id)
+    for cat_id in old.categories.keys() & new.categories.keys():
+        if (
+            old.categories[cat_id] != new.categories[cat_id]
+            or old.children.get(cat_id) != new.children.get(cat_id)
+        ):
+            changed.add(cat_id)
+
+    if old.texts != new.texts:
+        # names on every page are shortened to fit next to these texts
+        stale_menus = old.children.keys() | new.children.keys()
+    else:
+        stale_menus = {
+            parent_id
+            for parent_id in old.children.keys() | new.children.keys()
+            if old.children.get(parent_id) != new.children.get(parent_id)
+        }
+    stale_menus |= removed
+
+    return SnapshotDiff(added, removed, changed, stale_menus)
+
+
+def apply_diff(
+    old: DataSnapshot, new: DataSnapshot, diff: SnapshotDiff
+) -> DataSnapshot:
+    # unchanged records are carried over from the current snapshot as is
+    categories = dict(old.categories)
+    questions = dict(old.questions)
+    for node_id in diff.removed:
+        categories.pop(node_id, None)
+        questions.pop(node_id, None)
+    for node_id in diff.added | diff.changed:
+        if node_id < 0:
+            questions[node_id] = new.questions[node_id]
+        else:
+            categories[node_id] = new.categories[node_id]
+
+    return replace(new, categories=categories, questions=questions)
+
+
+class SnapshotBuilder:
+    """Collects parsed nodes into the flat indexes of a snapshot"""
+
+    def __init__(self, strict_names: bool = False):
+        self.categories = {}
+        self.questions = {}
+        self.parents = {}
+        self.children = {0: []}
+        self.taken_ids = set()
+        # (parent id, name) -> id of the menu item, to catch repeated names
+        self.names = {}
+        # False - a repeated name replaces the earlier node, like json.loads
+        # keeps the last value of a repeated key; True - the file is rejected
+        self.strict_names = strict_names
+
+    def _check(self, parent_id: int, path: tuple, depth: int) -> int | None:
+        # returns the position of a replaced node in its parent menu;
+        # depth counts categories only, a question is not a nesting level
+        if depth > DATA_MAX_DEPTH:
+            raise DataParseException(
+                f"categories are nested deeper than {DATA_MAX_DEPTH} levels "
+                f'(error on: "{" > ".join(path)}")'
+            )
+        if len(self.categories) + len(self.questions) >= DATA_MAX_NODES:
+            raise DataParseException(
+                f"more than {DATA_MAX_NODES} categories and questions "
+                f'(error on: "{" > ".join(path)}")'
+            )
+        node_id = self.names.get((parent_id, path[-1]))
+        if node_id is None:
+            return None
+        if self.strict_names:
+            raise DataParseException(
+                f'name is used twice in one category (error on: "{" > ".join(path)}")'
+            )
+        logger.warning(
+            'name is used twice in one category, the last one is kept: "%s"',
+            " > ".join(path),
+        )
+        return self._remove(node_id)
+
+    def _remove(self, node_id: int) -> int:
+        parent_id = self.parents[node_id]
+        siblings = self.children[parent_id]
+        position = siblings.index(node_id)
+        del siblings[position]
+        stack = [node_id]
+        while stack:
+            node_id = stack.pop()
+            stack.extend(self.children.pop(node_id, ()))
+            node = self.categories.pop(node_id, None) or self.questions.pop(node_id)
+            name = node.name if node_id > 0 else node.question
+            parent_id = self.parents.pop(node_id)
+            # a question inside a wrapper is not a menu item of its own
+            if self.names.get((parent_id, name)) == node_id:
+                del self.names[(parent_id, name)]
+            self.taken_ids.discard(node_id)
+        return position
+
+    def _attach(self, parent_id: int, node_id: int, name: str, position: int | None):
+        self.parents[node_id] = parent_id
+        if position is None:
+            self.children[parent_id].append(node_id)
+        else:
+            self.children[parent_id].insert(position, node_id)
+        self.names[(parent_id, name)] = node_id
+
+    def add_category(self, parent_id: int, path: tuple) -> int:
+        position = self._check(parent_id, path, depth=len(path))
+        name = sys.intern(path[-1])
+        cat_id = make_node_id(NODE_KINDS.CATEGORY, path, self.taken_ids)
+        self.categories[cat_id] = CategoryNode(name)
+        self._attach(parent_id, cat_id, name, position)
+        self.children[cat_id] = []
+        return cat_id
+
+    def add_question(self, parent_id: int, path: tuple, answer: str) -> int:
+        position = self._check(parent_id, path, depth=len(path) - 1)
+        name = sys.intern(path[-1])
+        q_id = make_node_id(NODE_KINDS.QUESTION, path, self.taken_ids)
+        category_id = parent_id
+        if parent_id == 0:
+            # top level question is shown through its own menu item
+            category_id = make_node_id(NODE_KINDS.WRAPPER, path, self.taken_ids)
+            self.categories[category_id] = CategoryNode(name, is_category=False)
+            self._attach(0, category_id, name, position)
+            self.children[category_id] = []
+            self.parents[q_id] = category_id
+            self.children[category_id].append(q_id)
+        else:
+            self._attach(parent_id, q_id, name, position)
+        self.questions[q_id] = QuestionNode(name, answer, category_id)
+        return q_id
+
+    def build(self, texts) -> DataSnapshot:
+        # check texts level params
+        if not isinstance(texts, dict):
+            raise DataParseException(
+                f'"{TOP_LEVEL_LABELS.TEXTS.value}" section must be dict'
+            )
+        new_texts = {}
+        for label in TEXTS_LABELS:
+            if label.value not in texts:
+                raise DataParseException(
+                    f'"{label.value}" must be in "{TOP_LEVEL_LABELS.TEXTS.value}" '
+                    "section"
+                )
+            new_texts[label.value] = texts[label.value]
+        logger.info("data parsed without errors")
+
+        return DataSnapshot(
+            texts=new_texts,
+            categories=self.categories,
+            questions=self.questions,
+            parents=self.parents,
+            # packed arrays instead of lists of int objects
+            children={
+                cat_id: array("q", items) for cat_id, items in self.children.items()
+            },
+            search_index=SearchIndex.build(self.questions, self.categories),
+        )
+
+
+def _value_type_error(name: str) -> DataParseException:
+    return DataParseException(
+        f'all values in "{TOP_LEVEL_LABELS.QUESTIONS.value}" '
+        f'section must be dict or str (error on value for: "{name}")'
+    )
+
+
+def build_snapshot(raw_json: dict) -> DataSnapshot:
     # check top level params
     top_params = [label.value for label in TOP_LEVEL_LABELS]
     for key in top_params:
         if key not in raw_json:
             raise DataParseException(f'"{key}" must be in top level json')
 
-    # check texts level params
-    texts_params = [label.value for label in TEXTS_LABELS]
-    new_texts = {}
-    for key in texts_params:
-        if key not in raw_json[TOP_LEVEL_LABELS.TEXTS.value]:
-            raise DataParseException(
-                f'"{key}" must be in "{TOP_LEVEL_LABELS.TEXTS.value}" section'
-            )
-        new_texts[key] = raw_json[TOP_LEVEL_LABELS.TEXTS.value][key]
-
-    # check question formats
-    def parse_structure(
-        data,
-        parent_id=None,
-        categories=None,
-        questions=None,
-        cat_counter=None,
-        q_counter=None,
-    ):
-        if categories is None:
-            categories = {}
-        if questions is None:
-            questions = {}
-        if cat_counter is None:
-            cat_counter = [1]
-        if q_counter is None:
-            q_counter = [-1]
-
-        tree = {}
-
-        for name, content in data.items():
+    # check question formats, walking with an explicit stack in file order
+    builder = SnapshotBuilder()
+    stack = [(0, (), iter(raw_json[TOP_LEVEL_LABELS.QUESTIONS.value].items()))]
+    while stack:
+        parent_id, parent_path, items = stack[-1]
+        for name, content in items:
+            path = parent_path + (name,)
             if isinstance(content, dict):
-                cat_id = cat_counter[0]
-                cat_counter[0] += 1
-                categories[cat_id] = {"name": name, "is_category": True}
-                tree[cat_id] = []
-                subtree, _, _ = parse_structure(
-                    content, cat_id, categories, questions, cat_counter, q_counter
-                )
-                if cat_id in subtree:
-                    tree[cat_id].extend(subtree[cat_id])
-                if parent_id is not None:
-                    if parent_id not in tree:
-                        tree[parent_id] = []
-                    tree[parent_id].append({cat_id: tree[cat_id]})
+                cat_id = builder.add_category(parent_id, path)
+                stack.append((cat_id, path, iter(content.items())))
+                break
             elif isinstance(content, str):
-                q_id = q_counter[0]
-                q_counter[0] -= 1
-                questions[q_id] = {
-                    "question": name,
-                    "answer": content,
-                    "category_id": parent_id,
-                }
-                if parent_id is not None:
-                    if parent_id not in tree:
-                        tree[parent_id] = []
-                    tree[parent_id].append(q_id)
-                else:
-                    cat_id = cat_counter[0]
-                    cat_counter[0] += 1
-                    categories[cat_id] = {"name": name, "is_category": False}
-                    tree[cat_id] = [q_id]
+                builder.add_question(parent_id, path, content)
             else:
-                raise DataParseException(
-                    f'all values in "{TOP_LEVEL_LABELS.QUESTIONS.value}" '
-                    f'section must be dict or str (error on value for: "{name}")'
-                )
+                raise _value_type_error(name)
+        else:
+            stack.pop()
+
+    return builder.build(raw_json[TOP_LEVEL_LABELS.TEXTS.value])
+
+
+def _stream_questions(events, builder: SnapshotBuilder):
+    event, _ = next(events)
+    if event != "start_map":
+        raise DataParseException(f'"{TOP_LEVEL_LABELS.QUESTIONS.value}" must be dict')
+    stack = [(0, ())]
+    for event, name in events:
+        if event == "end_map":
+            stack.pop()
+            if not stack:
+                return
+            continue
+        parent_id, parent_path = stack[-1]
+        path = parent_path + (name,)
+        event, content = next(events)
+        if event == "start_map":
+            stack.append((builder.add_category(parent_id, path), path))
+        elif event == "value" and isinstance(content, str):
+            builder.add_question(parent_id, path, content)
+        else:
+            raise _value_type_error(name)
+
+
+def parse_snapshot_stream(
+    file: BinaryIO, strict_names: bool = False
+) -> DataSnapshot:
+    # builds the snapshot straight from the json tokens, without keeping
+    # the whole decoded document in memory
+    # the top level object and the questions section take two more levels,
+    # one more lets the builder report a too deep category by its name
+    parser = JsonStreamParser(
+        file, max_size=DATA_MAX_SIZE, max_depth=DATA_MAX_DEPTH + 3
+    )
+    events = parser.events()
+    builder = SnapshotBuilder(strict_names)
+    found = {}
+    try:
+        event, _ = next(events)
+        if event != "start_map":
+            raise DataParseException("top level json must be dict")
+        for event, key in events:
+            if event == "end_map":
+                break
+            if key == TOP_LEVEL_LABELS.QUESTIONS.value:
+                _stream_questions(events, builder)
+                found[key] = True
+            else:
+                # texts and unknown top level keys are small, read them whole
+                found[key] = parser.read_value(events)
+        # checks that nothing follows the top level object
+        for _ in events:
+            pass
+    except DataParseException as ex:
+        line, column = parser.where()
+        raise DataParseException(f"{ex.detail} (line {line} column {column})")
+
+    for label in TOP_LEVEL_LABELS:
+        if label.value not in found:
+            raise DataParseException(f'"{label.value}" must be in top level json')
+    return builder.build(found[TOP_LEVEL_LABELS.TEXTS.value])
+
+
+def _deep_sizeof(obj, seen: set) -> int:
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, "__slots__"):
+            stack.extend(getattr(obj, slot) for slot in obj.__slots__)
+        elif hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+    return size
+
+
+def snapshot_memory_report(snapshot: DataSnapshot) -> dict:
+    # shared objects (interned strings, small ints) are counted once
+    seen = set()
+    nodes = len(snapshot.categories) + len(snapshot.questions)
+    tree_bytes = sum(
+        _deep_sizeof(part, seen)
+        for part in (
+            snapshot.categories,
+            snapshot.questions,
+            snapshot.parents,
+            snapshot.children,
+        )
+    )
+    index_bytes = _deep_sizeof(snapshot.search_index, seen)
+    return {
+        "nodes": nodes,
+        "tree_bytes": tree_bytes,
+        "index_bytes": index_bytes,
+        "bytes_per_node": (tree_bytes + index_bytes) // max(nodes, 1),
+    }
+
+
+def prepare_snapshot(
+    new_snapshot: DataSnapshot,
+) -> tuple[DataSnapshot, SnapshotDiff | None]:
+    # walks the whole catalogue, so it runs in the data thread; the published
+    # snapshot can not change meanwhile, updates hold _data_update_lock
+    current = questions_data.SNAPSHOT
+    if current.generation == 0:
+        return new_snapshot, None
+    diff = diff_snapshots(current, new_snapshot)
+    logger.info(
+        "data diff: +%s -%s ~%s nodes, %s menus to rerender",
+        len(diff.added),
+        len(diff.removed),
+        len(diff.changed),
+        len(diff.stale_menus),
+    )
+    return apply_diff(current, new_snapshot, diff), diff
+
+
+def publish_snapshot(
+    new_snapshot: DataSnapshot, diff: SnapshotDiff | None = None
+) -> DataSnapshot:
+    snapshot = questions_data.publish(new_snapshot)
+    if diff is None:
+        # publish all parsed data at once
+        render_cache.drop(snapshot.generation)
+    else:
+        render_cache.advance(
+            snapshot.generation, diff.stale_menus, diff.removed | diff.changed
+        )
+    logger.info("data snapshot published, generation: %s", snapshot.generation)
+
+    return snapshot
+
+
+def parse_json(raw_json: dict) -> DataSnapshot:
+    return publish_snapshot(*prepare_snapshot(build_snapshot(raw_json)))
+
+
+def load_snapshot(raw_data: bytes, strict_names: bool = False) -> DataSnapshot:
+    start = time.perf_counter()
+    snapshot = parse_snapshot_stream(io.BytesIO(raw_data), strict_names)
+    metrics.data_load_latency["parse"].observe(time.perf_counter() - start)
+    return replace(snapshot, source_hash=hashlib.sha256(raw_data).hexdigest())
+
 
-        return tree, categories, questions
+def read_file(file_path: str) -> bytes:
+    with open(file_path, "rb") as file:
+        return file.read()
 
-    res_tree, new_cats, new_questions = parse_structure(
-        raw_json[TOP_LEVEL_LABELS.QUESTIONS.value]
+
+def write_file_atomic(file_path: str, data: bytes):
+    # readers see either the old or the new file, never a half-written one
+    dir_name = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=dir_name, prefix=f".{os.path.basename(file_path)}.", suffix=".tmp"
     )
-    logger.info("data parsed without errors")
-    # set config params to parsed data
-    msg_texts.set_new_texts(new_texts)
-    logger.info("message texts updated without errors")
-    questions_data.set_new_questions(new_questions)
-    logger.info("questions dict updated without errors")
-    questions_data.set_new_tree(res_tree)
-    logger.info("tree dict updated without errors")
-    questions_data.set_new_cats(new_cats)
-    logger.info("categories dict updated without errors")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        try:
+            # mkstemp creates the file as 0600, keep the mode of the old one
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(file_path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# bump when the pickled structures change, old caches are then ignored
+DATA_CACHE_VERSION = b"8"
+DATA_CACHE_MAGIC = b"MYHOUSE-DATA-CACHE"
+
+
+def _data_cache_key(raw_data: bytes) -> bytes:
+    # prerendered menus depend on the page size, not only on the data
+    settings = DATA_CACHE_VERSION + b":%d:" % MENU_PAGE_SIZE
+    return hashlib.sha256(settings + raw_data).digest()
+
+
+def first_page_menus(snapshot: DataSnapshot) -> dict:
+    # only first pages are prerendered, the rest are rendered on demand;
+    # menus kept by a diff-applied publish are reused, so after an update
+    # only the stale ones are rendered again
+    menus = {}
+    for parent_id in snapshot.children:
+        menu = render_cache.get_menu(snapshot.generation, parent_id)
+        if menu is None:
+            menu = render_menu(snapshot, parent_id)
+        menus[(parent_id, 0)] = menu
+    return menus
+
+
+def write_data_cache(snapshot: DataSnapshot, raw_data: bytes) -> dict:
+    menus = first_page_menus(snapshot)
+    payload = pickle.dumps((snapshot, menus), protocol=pickle.HIGHEST_PROTOCOL)
+    write_file_atomic(
+        COMPILED_DATA_PATH, DATA_CACHE_MAGIC + _data_cache_key(raw_data) + payload
+    )
+    logger.info("compiled data cache written: %s", COMPILED_DATA_PATH)
+    return menus
+
+
+def read_data_cache(raw_data: bytes) -> tuple[DataSnapshot, dict] | None:
+    # the cache is written only by the bot itself, so unpickling it is trusted
+    header = DATA_CACHE_MAGIC + _data_cache_key(raw_data)
+    try:
+        with open(COMPILED_DATA_PATH, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if mapped[: len(header)] != header:
+                    logger.info("compiled data cache is outdated")
+                    return None
+                start = time.perf_counter()
+                with memoryview(mapped) as view:
+                    cached = pickle.loads(view[len(header) :])
+                metrics.data_load_latency["cache"].observe(time.perf_counter() - start)
+                return cached
+    except (FileNotFoundError, ValueError):
+        # ValueError - empty file can not be mapped
+        return None
+    except Exception as e:
+        logger.warning("cant read compiled data cache", exc_info=e)
+        return None
+
+
+# file operations and parsing run here one at a time, off the event loop
+_data_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="data-io")
+_data_update_lock = asyncio.Lock()
+
+
+async def run_in_data_thread(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_data_executor, partial(func, *args))
+
 
-    # FOR DEBUG
-    # print(json.dumps(res_tree, ensure_ascii=False))
+async def update_json_data(raw_data: bytes) -> str:
+    async with _data_update_lock:
+        # an uploaded file is checked strictly, files already on disk only
+        # get a warning about repeated names, so the bot still starts
+        snapshot = await run_in_data_thread(load_snapshot, raw_data, True)
+        backup_path = await run_in_data_thread(backup_store.add_file, JSON_DATA_PATH)
+        await run_in_data_thread(write_file_atomic, JSON_DATA_PATH, raw_data)
+        snapshot = publish_snapshot(
+            *await run_in_data_thread(prepare_snapshot, snapshot)
+        )
+        menus = await run_in_data_thread(write_data_cache, snapshot, raw_data)
+        render_cache.fill(snapshot.generation, menus)
+    return backup_path
+
+
+async def log_memory_report(snapshot: DataSnapshot):
+    report = await run_in_data_thread(snapshot_memory_report, snapshot)
+    logger.info(
+        "data memory: %s nodes, tree %s bytes, search index %s bytes, "
+        "%s bytes per node",
+        report["nodes"],
+        report["tree_bytes"],
+        report["index_bytes"],
+        report["bytes_per_node"],
+    )
 
 
 async def load_json_data():
     try:
-        with open(JSON_DATA_PATH, "r") as file:
-            data = json.load(file)
-            parse_json(data)
+        raw_data = await run_in_data_thread(read_file, JSON_DATA_PATH)
+        cached = await run_in_data_thread(read_data_cache, raw_data)
+        if cached is not None:
+            snapshot, menus = cached
+            snapshot = publish_snapshot(snapshot)
+            render_cache.warm(snapshot.generation, menus)
+            logger.info("data loaded from compiled cache")
+        else:
+            snapshot = publish_snapshot(
+                await run_in_data_thread(load_snapshot, raw_data)
+            )
+            menus = await run_in_data_thread(write_data_cache, snapshot, raw_data)
+            render_cache.warm(snapshot.generation, menus)
+        # walking every object takes a while on big catalogues, so the
+        # report is logged later without delaying the startup
+        task = asyncio.create_task(log_memory_report(snapshot))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
     except FileNotFoundError:
         logger.warning("json file is not found error")
         await json_not_loaded_notify()
+    except JSONDecodeError as ex:
+        logger.warning("cant decode json file error")
+        await json_format_error_notify(err_txt=str(ex))
     except DataParseException as ex:
         logger.warning("cant parse new json file error")
         await json_format_error_notify(err_txt=ex.detail)
 
 
+def _file_signature(file_path: str) -> tuple | None:
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+# sha256 of the last file that failed to load, it is not parsed again
+_rejected_source_hash = ""
+
+
+async def reload_changed_json_data():
+    global _rejected_source_hash
+    async with _data_update_lock:
+        try:
+            raw_data = await run_in_data_thread(read_file, JSON_DATA_PATH)
+        except FileNotFoundError:
+            return
+        source_hash = hashlib.sha256(raw_data).hexdigest()
+        if source_hash == questions_data.SNAPSHOT.source_hash:
+            # e.g. the file was just written by /update
+            return
+        if source_hash == _rejected_source_hash:
+            # admins were already notified about this very file
+            return
+
+        logger.info("json file changed on disk, reloading")
+        try:
+            snapshot = await run_in_data_thread(load_snapshot, raw_data)
+        except JSONDecodeError as ex:
+            logger.warning("cant decode changed json file error")
+            _rejected_source_hash = source_hash
+            return await json_format_error_notify(err_txt=str(ex))
+        except DataParseException as ex:
+            logger.warning("cant parse changed json file error")
+            _rejected_source_hash = source_hash
+            return await json_format_error_notify(err_txt=ex.detail)
+
+        snapshot = publish_snapshot(
+            *await run_in_data_thread(prepare_snapshot, snapshot)
+        )
+        menus = await run_in_data_thread(write_data_cache, snapshot, raw_data)
+        render_cache.fill(snapshot.generation, menus)
+    await json_updated_notify()
+
+
+async def watch_json_data():
+    if awatch is not None:
+        # inotify/kqueue based watching; the directory is watched because
+        # deploy tools usually replace the file by renaming a new one over it;
+        # logs, backups and the compiled cache live there too, so only events
+        # of the data file itself are let through
+        data_path = os.path.abspath(JSON_DATA_PATH)
+        async for _ in awatch(
+            os.path.dirname(data_path),
+            recursive=False,
+            watch_filter=lambda _, path: os.path.abspath(path) == data_path,
+        ):
+            try:
+                await reload_changed_json_data()
+            except Exception as e:
+                logger.error("error while reloading json file", exc_info=e)
+        return
+
+    last_signature = _file_signature(JSON_DATA_PATH)
+    while True:
+        await asyncio.sleep(DATA_WATCH_INTERVAL)
+        signature = _file_signature(JSON_DATA_PATH)
+        if signature == last_signature:
+            continue
+        last_signature = signature
+        try:
+            await reload_changed_json_data()
+        except Exception as e:
+            logger.error("error while reloading json file", exc_info=e)
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+def text_length(text: str) -> int:
+    # telegram counts message length in utf-16 code units
+    return len(text.encode("utf-16-le")) // 2
+
+
+def shorten(text: str, limit: int) -> str:
+    if text_length(text) <= limit:
+        return text
+    # a surrogate pair cut in half is dropped by errors="ignore"
+    cut = text.encode("utf-16-le")[: max(limit - 1, 0) * 2]
+    return cut.decode("utf-16-le", errors="ignore") + "…"
+
+
+def render_items(
+    data: DataSnapshot, items: list, offset: int = 0, name_limit: int | None = None
+) -> (str, list):
+    buttons = []
+    current_row = -1
+    counter = offset
+    text = ""
+    for key in items:
+        counter += 1
+        if key < 0:
+            name = data.questions[key].question
+        else:
+            name = data.categories[key].name
+        if name_limit is not None:
+            name = shorten(name, name_limit)
+        if key < 0:
+            text += f"{counter}. ❔ {name}\n\n"
+        else:
+            text += f"{counter}. 🏷 {name}\n\n"
+        current_row += 1
+        if current_row > 2:
+            current_row = 0
+        if current_row == 0:
+            buttons.append(
+                [
+                    InlineKeyboardButton(
+                        text=f"{number_to_emojis(counter)}",
+                        callback_data=go_data(key),
+                    )
+                ]
+            )
+        else:
+            buttons[-1].append(
+                InlineKeyboardButton(
+                    text=f"{number_to_emojis(counter)}",
+                    callback_data=go_data(key),
+                )
+            )
+
+    return text, buttons
+
+
+def menu_pages(data: DataSnapshot, parent_id: int) -> int:
+    items = data.get_category_items(cat_id=parent_id) or []
+    return max(1, -(-len(items) // MENU_PAGE_SIZE))
+
+
+def item_page(data: DataSnapshot, item_id: int) -> int:
+    # page of the parent menu on which the item is listed
+    items = data.get_category_items(cat_id=data.get_item_parent(item_id)) or []
+    try:
+        return items.index(item_id) // MENU_PAGE_SIZE
+    except ValueError:
+        return 0
+
+
+def _menu_header_length(data: DataSnapshot, parent_id: int) -> int:
+    # handlers put the start or select text (and the category name) above
+    # the menu, see start_cmd and _show_menu
+    length = 2 + max(
+        text_length(data.texts[TEXTS_LABELS.START.value]),
+        text_length(data.texts[TEXTS_LABELS.SELECT.value]),
+    )
+    if parent_id != 0:
+        length += text_length(data.categories[parent_id].name) + 2
+    return length
+
+
+def render_menu(
+    data: DataSnapshot, parent_id: int = 0, page: int = 0
+) -> (str, InlineKeyboardMarkup | None):
+    items = data.get_category_items(cat_id=parent_id) or []
+    pages = menu_pages(data, parent_id)
+    offset = page * MENU_PAGE_SIZE
+    page_items = items[offset : offset + MENU_PAGE_SIZE]
+    kb = None
+    text, buttons = render_items(data, page_items, offset=offset)
+    page_line = f"Страница {page + 1} из {pages}\n" if pages > 1 else ""
+
+    room = MESSAGE_TEXT_LIMIT - text_length(page_line)
+    if page_items:
+        room -= _menu_header_length(data, parent_id)
+    if page_items and text_length(text) > room:
+        # long names are shortened so that the page fits into one message
+        line_overhead = text_length(f"{offset + len(page_items)}. 🏷 \n\n")
+        name_limit = max(room // len(page_items) - line_overhead, 1)
+        text, buttons = render_items(
+            data, page_items, offset=offset, name_limit=name_limit
+        )
+
+    if pages > 1:
+        text += page_line
+        nav_row = []
+        if page > 0:
+            nav_row.append(
+                InlineKeyboardButton(
+                    text="◀️",
+                    callback_data=go_data(parent_id, page - 1),
+                )
+            )
+        if page < pages - 1:
+            nav_row.append(
+                InlineKeyboardButton(
+                    text="▶️",
+                    callback_data=go_data(parent_id, page + 1),
+                )
+            )
+        buttons.append(nav_row)
+
+    if buttons:
+        if parent_id != 0:
+            buttons.append(
+                [
+                    InlineKeyboardButton(
+                        text="⬅️ Назад",
+                        callback_data=back_data(parent_id),
+                    ),
+                    InlineKeyboardButton(
+                        text="⏺️ Главная",
+                        callback_data=go_data(0),
+                    ),
+                ]
+            )
+        kb = InlineKeyboardMarkup(inline_keyboard=buttons)
+
+    return text, kb
+
+
+def render_answer(data: DataSnapshot, q_id: int) -> (dict, InlineKeyboardMarkup):
+    question = data.questions[q_id]
+    text = Text(BlockQuote(question.question), "\n\n", question.answer)
+    kb = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(text="⬅️ Назад", callback_data=back_data(q_id)),
+                InlineKeyboardButton(
+                    text="⏺️ Главная",
+                    callback_data=go_data(0),
+                ),
+            ]
+        ]
+    )
+    return text.as_kwargs(), kb
+
+
 def number_to_emojis(number):
     emoji_digits = {
         "0": "0️⃣",
@@ -273,31 +1136,74 @@ def number_to_emojis(number):
     return "".join(result)
 
 
-def backup_file(file_path, backup_dir) -> str:
-    os.makedirs(backup_dir, exist_ok=True)
+class BackupStore:
+    """Content addressed store of gzip compressed data file versions"""
 
-    base_name = os.path.basename(file_path)
+    INDEX_NAME = "index.json"
 
-    # Create a timestamped backup file name
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_file_name = f"{base_name}.{timestamp}.bak"
-    backup_path = os.path.join(backup_dir, backup_file_name)
+    def __init__(self, directory: str, keep: int = 20):
+        self.directory = directory
+        self.keep = keep
 
-    # Copy the file
-    try:
-        shutil.copy2(file_path, backup_path)
-        logger.info(f"Backup created: {backup_path}")
+    def _object_path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, f"{content_hash}.json.gz")
+
+    def entries(self) -> list[dict]:
+        # newest first
+        try:
+            with open(os.path.join(self.directory, self.INDEX_NAME), "r") as file:
+                return json.load(file)["entries"]
+        except FileNotFoundError:
+            return []
 
-        # Clean up old backups (keep only the last 5)
-        backups = sorted(
-            [f for f in os.listdir(backup_dir) if f.startswith(base_name)], reverse=True
+    def _save_entries(self, entries: list[dict]):
+        write_file_atomic(
+            os.path.join(self.directory, self.INDEX_NAME),
+            json.dumps({"entries": entries}, ensure_ascii=False).encode(),
         )
 
-        for old_backup in backups[5:]:
-            old_backup_path = os.path.join(backup_dir, old_backup)
-            os.remove(old_backup_path)
-            logger.info(f"Old backup removed: {old_backup_path}")
+    def add(self, data: bytes) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        content_hash = hashlib.sha256(data).hexdigest()
+        object_path = self._object_path(content_hash)
 
-        return backup_path
-    except FileNotFoundError:
-        logger.error("Error while creating backup (file to backup not found)")
+        entries = self.entries()
+        if not os.path.exists(object_path):
+            write_file_atomic(object_path, gzip.compress(data))
+            logger.info("Backup created: %s", object_path)
+        else:
+            logger.info("Backup already stored: %s", object_path)
+        entries = [entry for entry in entries if entry["hash"] != content_hash]
+        entries.insert(
+            0,
+            {
+                "hash": content_hash,
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "size": len(data),
+            },
+        )
+
+        for old_entry in entries[self.keep :]:
+            old_path = self._object_path(old_entry["hash"])
+            if os.path.exists(old_path):
+                os.remove(old_path)
+                logger.info("Old backup removed: %s", old_path)
+        self._save_entries(entries[: self.keep])
+        return object_path
+
+    def add_file(self, file_path: str) -> str | None:
+        try:
+            return self.add(read_file(file_path))
+        except FileNotFoundError:
+            logger.error("Error while creating backup (file to backup not found)")
+
+    def get(self, number: int) -> bytes:
+        # number 1 is the most recent backup
+        if number < 1:
+            raise IndexError(number)
+        entry = self.entries()[number - 1]
+        with open(self._object_path(entry["hash"]), "rb") as file:
+            return gzip.decompress(file.read())
+
+
+backup_store = BackupStore(BACKUPS_DIR, keep=BACKUPS_KEEP)